@@ -0,0 +1,156 @@
+import asyncio
+from collections import namedtuple
+
+from .output_writes import OutputWriteError
+
+Sample = namedtuple("Sample", ["uid", "channel", "value", "timestamp"])
+
+
+class AsyncTFH:
+    """
+    asyncio facade of a running TFH. Samples are pushed from the bricklet callbacks into the event loop,
+    only channels somebody waits on or streams are forwarded at all.
+    Has to be created from within the event loop it is used in
+    """
+    def __init__(self, tfh, queue_size=1000):
+        self.tfh = tfh
+        self.queue_size = queue_size
+        self._loop = asyncio.get_running_loop()
+        # (uid, channel) -> futures / queues, channel None subscribes to all channels of a device
+        self._waiters = {}
+        self._streams = {}
+        # read from the callback threads, only changed in the event loop
+        self._subscribed = frozenset()
+        self._flush_waiters = []
+        self.tfh.value_listeners.append(self._on_value)
+        self.tfh.flush_listeners.append(self._on_flush)
+
+    def close(self):
+        self._detach()
+        for futures in self._waiters.values():
+            for future in futures:
+                future.cancel()
+        for _, future in self._flush_waiters:
+            future.cancel()
+
+    def _update_subscriptions(self):
+        self._subscribed = frozenset(key for key, subs in [*self._waiters.items(), *self._streams.items()] if subs)
+
+    def _detach(self):
+        if self._on_value in self.tfh.value_listeners:
+            self.tfh.value_listeners.remove(self._on_value)
+        if self._on_flush in self.tfh.flush_listeners:
+            self.tfh.flush_listeners.remove(self._on_flush)
+
+    # callback thread side
+
+    def _on_value(self, uid, channel, value, timestamp):
+        subscribed = self._subscribed
+        if (uid, channel) in subscribed or (uid, None) in subscribed:
+            self._call_soon(self._deliver, Sample(uid, channel, value, timestamp))
+
+    def _on_flush(self, flush_no):
+        if self._flush_waiters:
+            self._call_soon(self._resolve_flush, flush_no)
+
+    def _call_soon(self, callback, *args):
+        """
+        hands a call to the event loop, a closed loop unsubscribes from the TFH instead of raising in its threads
+        """
+        if not self._loop.is_closed():
+            try:
+                self._loop.call_soon_threadsafe(callback, *args)
+                return
+            except RuntimeError:
+                # closed in between
+                pass
+        self._detach()
+
+    # event loop side
+
+    def _deliver(self, sample):
+        waiters_done = False
+        for key in ((sample.uid, sample.channel), (sample.uid, None)):
+            futures = self._waiters.pop(key, None)
+            for future in futures or ():
+                waiters_done = True
+                if not future.done():
+                    future.set_result(sample)
+            for queue in self._streams.get(key, ()):
+                if queue.full():
+                    # slow consumer, drop the oldest sample
+                    queue.get_nowait()
+                queue.put_nowait(sample)
+        if waiters_done:
+            self._update_subscriptions()
+
+    def _resolve_flush(self, flush_no):
+        pending = []
+        for after, future in self._flush_waiters:
+            if flush_no > after:
+                if not future.done():
+                    future.set_result(flush_no)
+            else:
+                pending.append((after, future))
+        self._flush_waiters = pending
+
+    async def next_sample(self, uid, channel=0, timeout=None):
+        """
+        waits for the next sample of the channel, channel None accepts any channel of the device
+        """
+        future = self._loop.create_future()
+        self._waiters.setdefault((uid, channel), []).append(future)
+        self._update_subscriptions()
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            futures = self._waiters.get((uid, channel))
+            if futures and future in futures:
+                futures.remove(future)
+                self._update_subscriptions()
+
+    async def stream(self, uid, channel=None):
+        """
+        async iterator over the samples of a device or one of its channels, fed directly from the callbacks
+        """
+        key = (uid, channel)
+        queue = asyncio.Queue(self.queue_size)
+        self._streams.setdefault(key, set()).add(queue)
+        self._update_subscriptions()
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._streams[key].discard(queue)
+            self._update_subscriptions()
+
+    async def wait_flush(self, timeout=None):
+        """
+        waits until an output pass started after this call has finished
+        """
+        future = self._loop.create_future()
+        self._flush_waiters.append((self.tfh.output_flushes_started, future))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            # timed out or cancelled waiters must not keep the flushes calling into the loop
+            self._flush_waiters = [waiter for waiter in self._flush_waiters if waiter[1] is not future]
+
+    async def write(self, uid, channel, value, timeout=None):
+        """
+        sets an output value and waits for the output pass writing it.
+        returns True if the bricklet has acknowledged the value by then
+        """
+        try:
+            await self.write_many({(uid, channel): value}, timeout)
+        except OutputWriteError:
+            return False
+        return True
+
+    async def write_many(self, updates, timeout=None):
+        """
+        sets many outputs in the same output pass, see TFH.write_outputs.
+        returns {(uid, channel): value} once acknowledged, raises OutputWriteError otherwise
+        """
+        future = asyncio.wrap_future(self.tfh.write_outputs(updates), loop=self._loop)
+        return await asyncio.wait_for(future, timeout)
@@ -0,0 +1,291 @@
+"""
+In-process benchmark of TFH with mocked bricklets and connection: callback ingestion throughput, the per-cycle
+input / control / output steps and the startup through verify_config_devices and setup_devices,
+each at several device counts. Results are written as json to compare them across upgrades.
+
+    python -m <package>.benchmark --sizes 10 100 1000 --out bench.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import statistics
+from datetime import datetime as dt
+from time import perf_counter, sleep
+from unittest import mock
+
+from tinkerforge.ip_connection import IPConnection
+
+from . import brickd_hosts
+from . import tinkerforge_lib
+from .fake_brickd import device_specs, MASTER_BRICK
+from .tinkerforge_lib import TFH
+
+
+# every second output channel is supervised by an mfc entry, see make_config
+supervised_every = 2
+
+
+class BenchBricklet:
+    """
+    stands in for every tinkerforge binding, all methods are counted no-ops
+    """
+    calls = 0
+
+    def __init__(self, uid, ipcon):
+        self.uid = uid
+
+    def __getattr__(self, name):
+        if name.startswith("CALLBACK_"):
+            return name
+        return self._call
+
+    @staticmethod
+    def _call(*_):
+        BenchBricklet.calls += 1
+
+
+class StalledBricklet(BenchBricklet):
+    """
+    a bricklet that stopped answering, every call blocks like a request running into the connection timeout
+    """
+    stall = 0.05
+
+    def __init__(self):
+        super().__init__(None, None)
+
+    @staticmethod
+    def _call(*_):
+        sleep(StalledBricklet.stall)
+
+
+class BenchConnection:
+    """
+    IPConnection replacement, enumerate reports the devices of the current run synchronously
+    """
+    CALLBACK_ENUMERATE = IPConnection.CALLBACK_ENUMERATE
+    CALLBACK_CONNECTED = IPConnection.CALLBACK_CONNECTED
+    CALLBACK_DISCONNECTED = IPConnection.CALLBACK_DISCONNECTED
+    devices = {}
+
+    def __init__(self):
+        self.callbacks = {}
+
+    def register_callback(self, callback_id, function):
+        self.callbacks[callback_id] = function
+
+    def connect(self, host, port):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def enumerate(self):
+        cb = self.callbacks[IPConnection.CALLBACK_ENUMERATE]
+        for uid, device_identifier in self.devices.items():
+            cb(uid, "bench", "a", [1, 0, 0], [2, 0, 0], device_identifier, IPConnection.ENUMERATION_TYPE_AVAILABLE)
+
+
+def make_devices(count):
+    """
+    uid -> device identifier, cycling through all simulated device types
+    """
+    types = [device_identifier for device_identifier in device_specs if device_identifier != MASTER_BRICK]
+    return {f"B{i}": types[i % len(types)] for i in range(count)}
+
+
+def make_config(devices):
+    """
+    one entry per channel. Every supervised_every-th output channel is combined with the next free analog input
+    channel into an mfc entry with a permissible_deviation, so the control plan has deviations to check
+    """
+    config = {}
+    outputs, analog_inputs = [], []
+    for uid, device_identifier in devices.items():
+        spec = device_specs[device_identifier]
+        for channel in range(spec.channels):
+            key = f"{spec.name}_{uid}_{channel}"
+            entry = {"type": spec.config_type}
+            if spec.config_type == "valve":
+                entry.update(output_device=uid, output_channel=channel)
+                outputs.append(key)
+            else:
+                entry.update(input_device=uid, input_channel=channel)
+                if spec.signal and spec.config_type != "thermocouple":
+                    analog_inputs.append(key)
+            if spec.config_type == "thermocouple":
+                entry["tc_type"] = "K"
+            if device_identifier == 2116:
+                entry["output_mode"] = "voltage"
+            config[key] = entry
+    for output_key, input_key in zip(outputs[::supervised_every], analog_inputs):
+        input_entry = config.pop(input_key)
+        config[output_key].update(type="mfc", input_device=input_entry["input_device"],
+                                  input_channel=input_entry["input_channel"], permissible_deviation=0.1)
+    return config
+
+
+def summarize(samples):
+    return {
+        "n": len(samples),
+        "mean": statistics.fmean(samples),
+        "median": statistics.median(samples),
+        "p95": sorted(samples)[int(0.95 * (len(samples) - 1))],
+        "min": min(samples),
+    }
+
+
+def time_calls(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        samples.append(perf_counter() - start)
+    return summarize(samples)
+
+
+@contextlib.contextmanager
+def mocked_environment(devices):
+    BenchConnection.devices = devices
+    with mock.patch.object(brickd_hosts, "IPConnection", BenchConnection), \
+            mock.patch.object(tinkerforge_lib, "load_bricklet", lambda *_: BenchBricklet):
+        yield
+
+
+def start_tfh(devices):
+    """
+    builds a TFH for the devices with its main loop, failsafe watchdog and poll thread stopped, returns it with the
+    startup timings. The mocked bricklets send no callbacks, inputs tripped meanwhile are taken back
+    """
+    config = make_config(devices)
+    setup_time = []
+    setup_devices = TFH.setup_devices
+
+    def timed_setup_devices(self):
+        start = perf_counter()
+        setup_devices(self)
+        setup_time.append(perf_counter() - start)
+
+    with mock.patch.object(tinkerforge_lib, "get_config", lambda _: dict(config)), \
+            mock.patch.object(TFH, "setup_devices", timed_setup_devices), \
+            contextlib.redirect_stdout(io.StringIO()):
+        start = perf_counter()
+        tfh = TFH("bench", 4223, "bench")
+        startup = perf_counter() - start
+        tfh.run = False
+        tfh.main_loop.join()
+        tfh.poller.join()
+        tfh.watchdog.stop()
+    for uid, input_dev in tfh.inputs.items():
+        tfh.watchdog.clear(uid)
+        if hasattr(input_dev, "reset_activity"):
+            input_dev.reset_activity()
+            input_dev.operational = True
+    return tfh, {"startup_total": startup, "setup_devices": setup_time[0], "config_entries": len(config),
+                 "supervised_controls": len(tfh.control_plan),
+                 "deviation_checks": len(tfh.control_plan.deviation_index)}
+
+
+def bench_ingestion(tfh, repeat):
+    """
+    callback calls per second for every input callback, called directly like the callback thread does
+    """
+    calls = {
+        "collect_all": (TFH.IndustrialDualAnalogInV2, lambda dev: dev.collect_all((1000, 2000))),
+        "collect_single_current": (TFH.IndustrialDual020mAV2, lambda dev: dev.collect_single_current(1, 12000000)),
+        "collect_temperature": (TFH.ThermoCouple, lambda dev: dev.collect_temperature(2500)),
+        "cb_value": (TFH.IndustrialDigitalIn4, lambda dev: dev.cb_value(2, True, True)),
+    }
+    results = {}
+    for name, (cls, call) in calls.items():
+        devices = [dev for dev in tfh.inputs.values() if isinstance(dev, cls)]
+        if not devices:
+            continue
+        start = perf_counter()
+        for _ in range(repeat):
+            for dev in devices:
+                call(dev)
+        elapsed = perf_counter() - start
+        results[name] = {"calls": repeat * len(devices), "seconds": elapsed,
+                         "calls_per_second": repeat * len(devices) / elapsed}
+    return results
+
+
+def bench_steps(tfh, repeat):
+    outputs = [dev for dev in tfh.outputs.values() if hasattr(dev, "output_cnt")]
+    toggle = [False]
+
+    def change_all_outputs():
+        toggle[0] = not toggle[0]
+        for dev in outputs:
+            for channel in range(dev.output_cnt):
+                dev.values[channel] = toggle[0]
+        tfh._TFH__manage_outputs()
+
+    def change_and_wait():
+        change_all_outputs()
+        tfh.output_dispatcher.wait()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        steps = {
+            "manage_inputs": time_calls(tfh._TFH__manage_inputs, repeat),
+            "run_controls": time_calls(tfh._TFH__run_controls, repeat),
+            "manage_outputs_unchanged": time_calls(tfh._TFH__manage_outputs, repeat),
+            "manage_outputs_changed": time_calls(change_and_wait, repeat),
+        }
+        # the main loop side of an output pass while one bricklet does not answer
+        stalled = outputs[0].dev if outputs else None
+        if stalled is not None:
+            outputs[0].dev = StalledBricklet()
+            steps["manage_outputs_one_stalled"] = time_calls(change_all_outputs, repeat)
+            outputs[0].dev = stalled
+            tfh.output_dispatcher.wait()
+            tfh.output_dispatcher.release()
+        return steps
+
+
+def run(sizes, repeat, ingestion_repeat):
+    results = {}
+    for size in sizes:
+        devices = make_devices(size)
+        with mocked_environment(devices):
+            tfh, startup = start_tfh(devices)
+            BenchBricklet.calls = 0
+            steps = bench_steps(tfh, repeat)
+            steps["bus_calls"] = BenchBricklet.calls
+            results[str(size)] = {
+                "startup": startup,
+                "ingestion": bench_ingestion(tfh, ingestion_repeat),
+                "steps": steps,
+            }
+    return {
+        "meta": {
+            "timestamp": dt.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "ingestion_repeat": ingestion_repeat,
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark of the TFH hot paths with mocked bricklets")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="device counts")
+    parser.add_argument("--repeat", type=int, default=200, help="repetitions of each cycle step")
+    parser.add_argument("--ingestion-repeat", type=int, default=100, help="callbacks per device and callback type")
+    parser.add_argument("--out", default=None, help="json output file, stdout if omitted")
+    args = parser.parse_args()
+
+    report = json.dumps(run(args.sizes, args.repeat, args.ingestion_repeat), indent=2)
+    if args.out:
+        with open(args.out, "w") as out_file:
+            out_file.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from tinkerforge.ip_connection import IPConnection
+
+default_port = 4223
+
+# reserved top level config entry listing the brickd endpoints, e.g. ["192.168.0.10", "192.168.0.11:4224"]
+hosts_config_key = "brickd_hosts"
+
+
+def parse_endpoint(endpoint, port=default_port):
+    """
+    accepts "host", "host:port", (host, port) or {"host": ..., "port": ...} and returns (host, port)
+    """
+    if isinstance(endpoint, dict):
+        return endpoint["host"], int(endpoint.get("port", port))
+    if isinstance(endpoint, (list, tuple)):
+        return endpoint[0], int(endpoint[1])
+    host, _, endpoint_port = str(endpoint).partition(":")
+    return host, int(endpoint_port or port)
+
+
+def parse_endpoints(ip, port, config=None):
+    """
+    endpoints given by the config entry hosts_config_key take precedence over the ip and port arguments,
+    ip may also be a list of endpoints
+    """
+    endpoints = (config or {}).get(hosts_config_key) or ip
+    if not isinstance(endpoints, list):
+        endpoints = [endpoints]
+    return [parse_endpoint(endpoint, port or default_port) for endpoint in endpoints]
+
+
+class BrickdHost:
+    """
+    one IPConnection to one brickd, the callbacks of the connection are forwarded with the host name attached
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.name = f"{host}:{port}"
+        self.conn = IPConnection()
+        self.connected = False
+        # monotonic time of the last enumerate answer, see TFH.enumerate_devices
+        self.last_enumerate = None
+
+    def register_callbacks(self, cb_enumerate, cb_connected, cb_disconnected):
+        self.conn.register_callback(IPConnection.CALLBACK_ENUMERATE, partial(cb_enumerate, host=self.name))
+        self.conn.register_callback(IPConnection.CALLBACK_CONNECTED, partial(cb_connected, host=self.name))
+        self.conn.register_callback(IPConnection.CALLBACK_DISCONNECTED, partial(cb_disconnected, host=self.name))
+
+    def connect(self):
+        try:
+            self.conn.connect(self.host, self.port)
+        except Exception as exp:
+            print(f"connection to brickd {self.name} failed: {exp}")
+            return False
+        self.connected = True
+        return True
+
+
+def connect_hosts(hosts):
+    """
+    connects all hosts concurrently, an unreachable host only delays its own connection attempt.
+    returns the hosts that are connected
+    """
+    if not hosts:
+        return []
+    with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+        results = list(executor.map(BrickdHost.connect, hosts))
+    return [host for host, connected in zip(hosts, results) if connected]
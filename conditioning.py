@@ -0,0 +1,140 @@
+import numpy as np
+
+
+class ConditioningPlan:
+    """
+    calibration and filtering of the conditioned input channels, run once per cycle by the main loop over all of them
+    at once. The callbacks of a conditioned channel only accumulate their samples (see InputDevice.store), each cycle
+    the mean of the samples since the last one is calibrated, filtered and written to the values of the device.
+    Like the control plan it refers to device objects and has to be compiled again when one is replaced
+    """
+    def __init__(self, devices, channels, configs):
+        # per device: (device, channel indices, spare accumulator), the channels are flattened in this order.
+        # Devices have a handful of channels, gathering and writing back is cheaper in plain python than per device
+        # numpy calls
+        self.devices = [(dev, tuple(device_channels), dev.new_accumulator())
+                        for dev, device_channels in zip(devices, channels)]
+        n = sum(len(device_channels) for device_channels in channels)
+
+        # polynomial coefficients, one row per channel in ascending order, padded with zeros
+        degree = max((len(cfg.calibration or (0, 1)) for cfg in configs), default=2)
+        self.coefficients = np.zeros((n, degree))
+        for i, cfg in enumerate(configs):
+            calibration = cfg.calibration or (0, 1)
+            self.coefficients[i, :len(calibration)] = calibration
+
+        filters = [cfg.filter for cfg in configs]
+        self.ema_index = np.array([i for i, name in enumerate(filters) if name == "ema"], dtype=int)
+        self.ema_alpha = np.array([configs[i].alpha for i in self.ema_index], dtype=float)
+        self.ema_state = np.full(len(self.ema_index), np.nan)
+        # moving average and median share a ring buffer of the last window values per channel, slots beyond the
+        # window of a channel stay NaN and are ignored by nanmean / nanmedian
+        self.window_filters = []
+        for name, reduce in (("moving_average", np.nanmean), ("median", np.nanmedian)):
+            index = np.array([i for i, f in enumerate(filters) if f == name], dtype=int)
+            if not len(index):
+                continue
+            windows = np.array([configs[i].window for i in index])
+            self.window_filters.append((index, windows, np.full((len(index), windows.max()), np.nan),
+                                        np.zeros(len(index), dtype=int), reduce))
+        self.output = np.full(n, np.nan)
+
+    def __len__(self):
+        return len(self.output)
+
+    @classmethod
+    def compile(cls, conditioning, inputs):
+        """
+        conditioning maps (uid, channel) to its ConditioningConfig, devices without conditioned channels are switched
+        back to storing their samples directly
+        """
+        devices, channels, configs = [], [], []
+        for uid, dev in inputs.items():
+            if not hasattr(dev, "set_conditioned"):
+                continue
+            device_channels = [channel for channel in range(dev.input_cnt) if (uid, channel) in conditioning]
+            dev.set_conditioned(device_channels)
+            if device_channels:
+                devices.append(dev)
+                channels.append(device_channels)
+                configs.extend(conditioning[(uid, channel)] for channel in device_channels)
+        return cls(devices, channels, configs)
+
+    def step(self):
+        """
+        conditions the samples that arrived since the last step, channels without new samples keep their value
+        """
+        if not len(self.output):
+            return
+        sums, counts = [], []
+        devices = self.devices
+        for i, (dev, channels, spare) in enumerate(devices):
+            accumulator = dev.swap_accumulator(spare)
+            cnt = dev.input_cnt
+            for channel in channels:
+                sums.append(accumulator[channel])
+                counts.append(accumulator[cnt + channel])
+            # swapped out under the lock of the device, no callback writes into it any more
+            for j in range(len(accumulator)):
+                accumulator[j] = 0.0
+            devices[i] = (dev, channels, accumulator)
+
+        counts = np.array(counts)
+        fresh = counts > 0
+        if not fresh.any():
+            return
+        sums = np.array(sums)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            raw = sums / counts
+        # Horner scheme over all channels at once
+        coefficients = self.coefficients
+        calibrated = coefficients[:, -1].copy()
+        for k in range(coefficients.shape[1] - 2, -1, -1):
+            calibrated = calibrated * raw + coefficients[:, k]
+
+        output = self.output
+        output[fresh] = calibrated[fresh]
+
+        if len(self.ema_index):
+            index = self.ema_index
+            update = fresh[index]
+            state = self.ema_state
+            x = calibrated[index]
+            smoothed = np.where(np.isnan(state), x, self.ema_alpha * x + (1 - self.ema_alpha) * state)
+            state[update] = smoothed[update]
+            output[index[update]] = state[update]
+
+        for index, windows, ring, positions, reduce in self.window_filters:
+            update = np.flatnonzero(fresh[index])
+            if not len(update):
+                continue
+            ring[update, positions[update]] = calibrated[index[update]]
+            positions[update] = (positions[update] + 1) % windows[update]
+            output[index[update]] = reduce(ring[update], axis=1)
+
+        values = output.tolist()
+        updated = fresh.tolist()
+        i = 0
+        for dev, channels, _ in devices:
+            if dev.operational:
+                device_values = dev.values
+                for k, channel in enumerate(channels, i):
+                    if updated[k]:
+                        device_values[channel] = values[k]
+            i += len(channels)
+
+    def reset(self, dev):
+        """
+        forgets the filter state of a device, e.g. after it timed out
+        """
+        start = 0
+        for entry_dev, channels, _ in self.devices:
+            if entry_dev is not dev:
+                start += len(channels)
+                continue
+            channels = np.arange(start, start + len(channels))
+            self.ema_state[np.isin(self.ema_index, channels)] = np.nan
+            for index, _, ring, positions, _ in self.window_filters:
+                rows = np.isin(index, channels)
+                ring[rows] = np.nan
+                positions[rows] = 0
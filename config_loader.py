@@ -0,0 +1,361 @@
+import json
+import os
+from collections import namedtuple
+from threading import Lock
+
+from .control_types import Controls
+
+config_dir = "./json_files"
+
+# threshold options of the bricklet callback configurations: off, outside, inside, smaller, greater
+threshold_options = ("x", "o", "i", "<", ">")
+thermocouple_types = ("B", "E", "J", "K", "N", "R", "S", "T")
+# edge types of the hardware edge counter of the digital inputs
+edge_types = {"rising": 0, "falling": 1, "both": 2}
+# on-device averaging of the thermocouple bricklet
+averaging_options = (1, 2, 4, 8, 16)
+filter_types = ("moving_average", "ema", "median")
+# modes of the output bricklets with more than one setter, see device_descriptors
+output_modes = ("voltage", "current")
+
+# expected types of the known entry keys, other keys are left to the controls using them
+entry_schema = {
+    "type": str,
+    "input_device": str,
+    "input_channel": int,
+    "output_device": str,
+    "output_channel": int,
+    "output_mode": str,
+    "tc_type": str,
+    "callback_period": int,
+    "poll": bool,
+    "value_has_to_change": bool,
+    "threshold": dict,
+    "edge_count": (dict, bool),
+    "sample_rate": int,
+    "averaging": int,
+    "conditioning": dict,
+    "safe_state": (int, float, bool),
+    "failsafe_inputs": list,
+    "timeout": (int, float),
+    "permissible_deviation": (int, float),
+}
+
+# callback options of one input channel, None leaves the default of the device class. period and timeout are given
+# in ms, minimum and maximum of the threshold in the unit of the bricklet API (e.g. 1/100 °C, mV, nA)
+CallbackConfig = namedtuple("CallbackConfig", ["period", "value_has_to_change", "option", "minimum", "maximum",
+                                               "timeout", "counter", "sample_rate", "averaging", "poll"],
+                            defaults=(None, None, None, None))
+
+# edge counter mode of a digital input channel: edge type (0 rising, 1 falling, 2 both), debounce in ms and the
+# pulses making up one unit of the measured rate (e.g. pulses per liter of a flow meter)
+CounterConfig = namedtuple("CounterConfig", ["edge_type", "debounce", "pulses_per_unit"])
+
+
+# conditioning of one input channel in the main loop: calibration coefficients in ascending order
+# (value = c0 + c1 * raw + c2 * raw² ...) and a filter over the last window cycles or with the ema factor alpha
+ConditioningConfig = namedtuple("ConditioningConfig", ["calibration", "filter", "window", "alpha"])
+
+
+def parse_callback_config(entry):
+    """
+    reads the optional callback_period, value_has_to_change, threshold and timeout keys of a config entry,
+    threshold is {"option": "o", "min": 0, "max": 0}. sample_rate (sps) and averaging select the on-device averaging,
+    poll reads the channel by its getter every callback_period instead of a callback
+    """
+    threshold = entry.get("threshold") or {}
+    return CallbackConfig(entry.get("callback_period"), entry.get("value_has_to_change"),
+                          threshold.get("option"), threshold.get("min"), threshold.get("max"),
+                          entry.get("timeout"), parse_counter_config(entry), entry.get("sample_rate"),
+                          entry.get("averaging"), entry.get("poll"))
+
+
+def parse_conditioning(entry):
+    """
+    reads the optional conditioning key {"calibration": [0, 1], "filter": "ema", "window": 5, "alpha": 0.2},
+    None for channels stored as they come
+    """
+    conditioning = entry.get("conditioning")
+    if not conditioning:
+        return None
+    calibration = conditioning.get("calibration")
+    return ConditioningConfig(tuple(calibration) if isinstance(calibration, list) else calibration,
+                              conditioning.get("filter"), conditioning.get("window", 5),
+                              conditioning.get("alpha", 0.2))
+
+
+def parse_counter_config(entry):
+    """
+    reads the optional edge_count key {"edge": "rising", "debounce": 10, "pulses_per_unit": 1}, FlowMeter entries
+    count edges unless edge_count is false. Returns None for channels without counter mode
+    """
+    counter = entry.get("edge_count", entry.get("type") == "FlowMeter")
+    if not counter:
+        return None
+    if counter is True:
+        counter = {}
+    return CounterConfig(edge_types.get(counter.get("edge", "rising"), counter.get("edge")),
+                         counter.get("debounce", 10), counter.get("pulses_per_unit", 1))
+
+
+def contains_modbus(item):
+    """
+    Rekursive Hilfsfunktion, die prüft, ob im übergebenen Objekt (String, Liste, Dict)
+    der Substring "modbus" (oder "mobus") enthalten ist.
+    """
+    if isinstance(item, str):
+        # Prüft in Kleinbuchstaben, ob "modbus" oder "mobus" vorkommt
+        return "modbus" in item.lower() or "mobus" in item.lower()
+    elif isinstance(item, dict):
+        return any(contains_modbus(value) for value in item.values())
+    elif isinstance(item, list):
+        return any(contains_modbus(elem) for elem in item)
+    else:
+        return False
+
+
+def config_path(config_name):
+    return os.path.join(config_dir, f"{config_name}.json")
+
+
+def config_mtime(config_name):
+    """
+    modification time (ns) of the json config, None for the config module or a missing file
+    """
+    if not config_name:
+        return None
+    try:
+        return os.stat(config_path(config_name)).st_mtime_ns
+    except OSError:
+        return None
+
+
+# path → (mtime_ns, size, filtered config)
+_cache = {}
+_cache_lock = Lock()
+
+
+def load_config(config_name):
+    """
+    Lädt die Konfiguration entweder aus einer JSON-Datei oder aus dem config-Modul
+    und filtert dabei alle Einträge heraus, die den String "Modbus" (oder "Mobus") enthalten.
+    Json files are parsed and filtered once per modification time, every call gets its own top level dict.
+
+    :param config_name: Name der JSON-Datei (ohne Endung) oder False, um das config-Modul zu verwenden.
+    :return: Gefiltertes Konfigurationsdictionary oder None bei Fehler.
+    """
+    try:
+        if not config_name:
+            import config as cfg
+            return {k: v for k, v in cfg.config.items() if not contains_modbus(v)}
+
+        path = config_path(config_name)
+        stat = os.stat(path)
+        with _cache_lock:
+            cached = _cache.get(path)
+            if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+                return dict(cached[2])
+        with open(path, 'r') as config_file:
+            config_data = json.load(config_file)
+        filtered_config = {k: v for k, v in config_data.items() if not contains_modbus(v)}
+        with _cache_lock:
+            _cache[path] = (stat.st_mtime_ns, stat.st_size, filtered_config)
+        return dict(filtered_config)
+
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        print(f"Error loading config: {e}")
+        return None
+
+
+class DeviceLayout:
+    """
+    the devices a valid config asks for: required uids, the config keys using each uid, their args and callback
+    options. Two layouts are compared per uid to find the devices a reload has to set up again
+    """
+    def __init__(self):
+        self.input_uids = set()
+        self.output_uids = set()
+        self.uid_to_device_keys = {}  # UID → Liste von device_keys, falls mehrere Keys dasselbe Gerät verwenden
+        self.args = {}
+        self.output_modes = {}  # output UID → output_mode, shared by all entries using the device
+        self.callback_configs = {}  # UID → {channel: CallbackConfig}
+        self.conditioning = {}  # (UID, channel) → ConditioningConfig
+        self.safe_states = {}  # input UID → [(device_key, output UID, channel, safe value)]
+        self.control_keys = []
+        self.skipped = []
+
+    def uids(self):
+        return self.input_uids | self.output_uids
+
+    def device_signature(self, uid):
+        keys = self.uid_to_device_keys.get(uid, [])
+        return (uid in self.input_uids, uid in self.output_uids, tuple(self.args.get(key) for key in keys),
+                self.output_modes.get(uid), tuple(sorted(self.callback_configs.get(uid, {}).items())))
+
+
+def check_type(device_key, key, value, errors):
+    expected = entry_schema.get(key)
+    if expected is None or value is None:
+        return True
+    if isinstance(value, bool) and expected is int or not isinstance(value, expected):
+        errors.append(f"{device_key}: {key} has to be of type "
+                      f"{' or '.join(t.__name__ for t in (expected if isinstance(expected, tuple) else (expected,)))}")
+        return False
+    return True
+
+
+def check_conditioning(conditioning):
+    errors = []
+    calibration = conditioning.calibration
+    if calibration is not None and (not isinstance(calibration, tuple) or not calibration or not all(
+            isinstance(c, (int, float)) and not isinstance(c, bool) for c in calibration)):
+        errors.append("conditioning calibration has to be a list of numbers")
+    if conditioning.filter is not None and conditioning.filter not in filter_types:
+        errors.append(f"conditioning filter has to be one of {', '.join(filter_types)}")
+    if not isinstance(conditioning.window, int) or isinstance(conditioning.window, bool) or conditioning.window < 1:
+        errors.append("conditioning window has to be a positive integer")
+    if not isinstance(conditioning.alpha, (int, float)) or not 0 < conditioning.alpha <= 1:
+        errors.append("conditioning alpha has to be in (0, 1]")
+    return errors
+
+
+def check_config(config):
+    """
+    validates the whole config in one pass and builds its DeviceLayout, returns (layout, errors).
+    All errors are collected instead of stopping at the first one
+    """
+    layout = DeviceLayout()
+    errors = []
+    channels_required = {}
+
+    if not isinstance(config, dict):
+        return layout, ["config has to be a mapping of device keys to entries"]
+
+    for device_key, value in config.items():
+        layout.args[device_key] = " "
+        if not isinstance(value, dict):
+            errors.append(f"{device_key}: entry has to be a mapping")
+            continue
+        if "type" not in value:
+            errors.append(f"{device_key}: type missing")
+            continue
+        if not all([check_type(device_key, key, field, errors) for key, field in value.items()]):
+            continue
+
+        # Überspringe externe Geräte, z.B. Modbus oder über andere Protokolle
+        if "extern" in value["type"].lower() or "modbus_pump" in value["type"].lower() or \
+                "modbus" in value.get("input_device", "").lower() or \
+                "modbus" in value.get("output_device", "").lower():
+            layout.skipped.append(device_key)
+            continue
+        type_requirements = Controls.types.get(value["type"], Controls.Entries.hasOutputs + Controls.Entries.hasInputs)
+
+        def use_channel(uid, channel):
+            used_channels = channels_required.setdefault(uid, [])
+            if channel in used_channels:
+                errors.append(f"{device_key}: channel {channel} of {uid} is already used by another entry")
+            used_channels.append(channel)
+            layout.uid_to_device_keys.setdefault(uid, []).append(device_key)
+
+        if type_requirements & Controls.Entries.hasOutputs:
+            if not all(key in value for key in ("output_device", "output_channel")):
+                errors.append(f"{device_key}: output_device or output_channel missing")
+            else:
+                output_uid = value["output_device"]
+                use_channel(output_uid, value["output_channel"])
+                layout.output_uids.add(output_uid)
+                if "output_mode" in value:
+                    output_mode = value["output_mode"]
+                    if output_mode not in output_modes:
+                        errors.append(f"{device_key}: output_mode has to be one of {', '.join(output_modes)}")
+                    elif layout.output_modes.setdefault(output_uid, output_mode) != output_mode:
+                        errors.append(f"{device_key}: output_mode {output_mode} conflicts with "
+                                      f"{layout.output_modes[output_uid]} of another entry using {output_uid}")
+
+        if type_requirements & Controls.Entries.hasInputs:
+            required_keys = ("input_device",) if value["type"] == "thermocouple" else ("input_device", "input_channel")
+            if value["type"] == "thermocouple":
+                # Spezielle Behandlung für Thermoelemente
+                if value.get("tc_type") not in thermocouple_types:
+                    errors.append(f"{device_key}: tc_type has to be one of {', '.join(thermocouple_types)}")
+                else:
+                    layout.args[device_key] = value["tc_type"]
+            if not all(key in value for key in required_keys):
+                errors.append(f"{device_key}: {' or '.join(required_keys)} missing")
+            else:
+                input_uid = value["input_device"]
+                input_channel = value.get("input_channel", 0)
+                use_channel(input_uid, input_channel)
+                layout.input_uids.add(input_uid)
+                callback_config = parse_callback_config(value)
+                if callback_config.option is not None and callback_config.option not in threshold_options:
+                    errors.append(f"{device_key}: unknown threshold option {callback_config.option}")
+                if callback_config.period is not None and callback_config.period < 0:
+                    errors.append(f"{device_key}: callback_period must not be negative")
+                if callback_config.timeout is not None and callback_config.timeout <= 0:
+                    errors.append(f"{device_key}: timeout has to be positive")
+                counter = callback_config.counter
+                if counter is not None:
+                    if counter.edge_type not in edge_types.values():
+                        errors.append(f"{device_key}: edge_count edge has to be one of {', '.join(edge_types)}")
+                    if not isinstance(counter.debounce, int) or isinstance(counter.debounce, bool) \
+                            or not 0 <= counter.debounce <= 255:
+                        errors.append(f"{device_key}: edge_count debounce has to be 0 to 255 ms")
+                    if not isinstance(counter.pulses_per_unit, (int, float)) or counter.pulses_per_unit <= 0:
+                        errors.append(f"{device_key}: edge_count pulses_per_unit has to be positive")
+                    if callback_config.period == 0:
+                        errors.append(f"{device_key}: edge counters are polled, callback_period must not be 0")
+                if callback_config.poll and callback_config.period == 0:
+                    errors.append(f"{device_key}: polled channels need a callback_period above 0")
+                if callback_config.sample_rate is not None and callback_config.sample_rate <= 0:
+                    errors.append(f"{device_key}: sample_rate has to be positive")
+                if callback_config.averaging is not None and callback_config.averaging not in averaging_options:
+                    errors.append(f"{device_key}: averaging has to be one of {', '.join(map(str, averaging_options))}")
+                layout.callback_configs.setdefault(input_uid, {})[input_channel] = callback_config
+                conditioning = parse_conditioning(value)
+                if conditioning is not None:
+                    errors.extend(f"{device_key}: {error}" for error in check_conditioning(conditioning))
+                    layout.conditioning[(input_uid, input_channel)] = conditioning
+
+        layout.control_keys.append(device_key)
+
+    find_safe_states(config, layout, errors)
+    return layout, errors
+
+
+def find_safe_states(config, layout, errors):
+    """
+    the outputs to switch to their safe_state when an input is lost: for each input uid the entries using it are found
+    through uid_to_device_keys, an entry with safe_state depends on its own input and on the keys in failsafe_inputs
+    """
+    dependents = {}  # input device_key → device_keys whose safe_state depends on it
+    for device_key in layout.control_keys:
+        entry = config[device_key]
+        if "safe_state" not in entry and "failsafe_inputs" not in entry:
+            continue
+        if "output_device" not in entry:
+            errors.append(f"{device_key}: safe_state and failsafe_inputs need an output_device")
+            continue
+        if "safe_state" not in entry:
+            errors.append(f"{device_key}: failsafe_inputs without safe_state")
+            continue
+        if "input_device" in entry:
+            dependents.setdefault(device_key, []).append(device_key)
+        for input_key in entry.get("failsafe_inputs", []):
+            if not isinstance(config.get(input_key), dict) or "input_device" not in config[input_key]:
+                errors.append(f"{device_key}: failsafe input {input_key} is no input entry of the config")
+                continue
+            dependents.setdefault(input_key, []).append(device_key)
+
+    for uid in layout.input_uids:
+        safe_states = []
+        for input_key in layout.uid_to_device_keys.get(uid, []):
+            if config[input_key].get("input_device") != uid:
+                continue
+            for device_key in dependents.get(input_key, []):
+                entry = config[device_key]
+                safe_state = (device_key, entry["output_device"], entry.get("output_channel", 0), entry["safe_state"])
+                if safe_state not in safe_states:
+                    safe_states.append(safe_state)
+        if safe_states:
+            layout.safe_states[uid] = safe_states
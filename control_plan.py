@@ -0,0 +1,76 @@
+import numpy as np
+
+# a deviation has to persist this long (seconds) before it is reported
+deviation_hold_time = 30
+
+# control types that are handled outside of the library
+unsupervised_types = ("easy_PI", "direct_Heat")
+
+
+class ControlPlan:
+    """
+    the controls of the config that need supervision each cycle, compiled once into resolved device references,
+    channel indices and threshold arrays so the per-cycle step does not touch the config.
+    The plan refers to device objects, it has to be compiled again when a device object is replaced
+    """
+    def __init__(self, names, input_devs, input_channels, output_devs, output_channels, deviations):
+        self.names = names
+        self.input_devs = input_devs
+        self.input_channels = input_channels
+
+        # deviation supervision, only the controls with a permissible_deviation and an output
+        self.deviation_index = np.flatnonzero(~np.isnan(deviations))
+        self.deviation_sources = [(input_devs[i], input_channels[i], output_devs[i], output_channels[i])
+                                  for i in self.deviation_index]
+        self.thresholds = deviations[self.deviation_index]
+        self.deviating_since = np.full(len(self.deviation_index), np.nan)
+        self.reported = np.zeros(len(self.deviation_index), dtype=bool)
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def compile(cls, config, inputs, outputs):
+        names, input_devs, input_channels, output_devs, output_channels, deviations = [], [], [], [], [], []
+        for control_name, control_rule in config.items():
+            control_type = control_rule.get("type", "")
+            input_dev = inputs.get(control_rule.get("input_device"))
+            if input_dev is None or control_type in unsupervised_types or "extern" in control_type.lower():
+                continue
+            output_dev = outputs.get(control_rule.get("output_device"))
+            # a 0 value is technically False but ... not a sensible value either
+            permissible_deviation = control_rule.get("permissible_deviation", False)
+
+            names.append(control_name)
+            input_devs.append(input_dev)
+            input_channels.append(control_rule.get("input_channel", 0))
+            output_devs.append(output_dev)
+            output_channels.append(control_rule.get("output_channel", 0))
+            deviations.append(permissible_deviation if permissible_deviation and output_dev is not None else np.nan)
+        return cls(names, input_devs, input_channels, output_devs, output_channels,
+                   np.array(deviations, dtype=float))
+
+    def check_deviations(self, now):
+        """
+        compares input and commanded output of all supervised controls at once.
+        returns the indices into names of deviations that just exceeded the hold time, and of deviations that started
+        or ended in this step
+        """
+        n = len(self.deviation_sources)
+        if not n:
+            return [], [], []
+        actual = np.fromiter((i_dev.values[i_ch] if i_dev.operational else np.nan
+                              for i_dev, i_ch, _, _ in self.deviation_sources), float, n)
+        target = np.fromiter((o_dev.values[o_ch] for _, _, o_dev, o_ch in self.deviation_sources), float, n)
+        exceeded = np.abs(actual - target) > self.thresholds * np.abs(target)
+
+        started = exceeded & np.isnan(self.deviating_since)
+        ended = ~exceeded & ~np.isnan(self.deviating_since)
+        self.deviating_since[started] = now
+        self.deviating_since[ended] = np.nan
+        self.reported[ended] = False
+
+        overdue = exceeded & ~self.reported & (now - self.deviating_since > deviation_hold_time)
+        self.reported |= overdue
+        return (self.deviation_index[overdue].tolist(), self.deviation_index[started].tolist(),
+                self.deviation_index[ended].tolist())
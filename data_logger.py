@@ -0,0 +1,310 @@
+"""
+Background recording of all input samples into memory-mapped binary files. The callbacks only append to a deque,
+a writer thread moves the samples in batches into preallocated files that are rotated when full.
+
+File layout, little endian:
+    0   8s  magic
+    8   u4  header size, the records start there
+    12  u4  record size
+    16  u8  number of valid records, updated after each batch
+    24      json header {"version", "created", "capacity", "channels": [{"uid", "channel", "key"}, ...]}
+    ..      records (timestamp f8 unix seconds, channel u4 index into channels, value f8)
+
+    python -m <package>.data_logger export logs/ --out run.csv
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import struct
+import sys
+import threading
+from collections import deque
+from time import sleep, strftime, time
+
+import numpy as np
+
+magic = b"TFHLOG\x00\x01"
+prefix_format = "<8sIIQ"
+prefix_size = struct.calcsize(prefix_format)
+count_offset = 16
+record_dtype = np.dtype([("timestamp", "<f8"), ("channel", "<u4"), ("value", "<f8")])
+file_suffix = ".tfhlog"
+
+# records per file, 1e6 records are 20 MB
+default_file_records = 1_000_000
+# seconds between two batches of the writer thread
+default_flush_interval = 0.5
+
+
+class LogFile:
+    """
+    one preallocated log file opened for writing
+    """
+    def __init__(self, path, channels, capacity):
+        header = json.dumps({"version": 1, "created": time(), "capacity": capacity,
+                             "channels": channels}).encode()
+        header_size = -(-(prefix_size + len(header)) // 8) * 8
+        self.path = path
+        self.capacity = capacity
+        self.header_size = header_size
+        with open(path, "wb") as log_file:
+            log_file.write(struct.pack(prefix_format, magic, header_size, record_dtype.itemsize, 0))
+            log_file.write(header.ljust(header_size - prefix_size))
+            log_file.truncate(header_size + capacity * record_dtype.itemsize)
+        self.records = np.memmap(path, dtype=record_dtype, mode="r+", offset=header_size, shape=(capacity,))
+        self.count_field = np.memmap(path, dtype="<u8", mode="r+", offset=count_offset, shape=(1,))
+        self.count = 0
+
+    def free(self):
+        return self.capacity - self.count
+
+    def write(self, records):
+        end = self.count + len(records)
+        self.records[self.count:end] = records
+        # the count is published after the records, a reader never sees unwritten records
+        self.count_field[0] = end
+        self.count = end
+
+    def close(self):
+        self.records.flush()
+        self.count_field.flush()
+        del self.records, self.count_field
+        if self.count < self.capacity:
+            os.truncate(self.path, self.header_size + self.count * record_dtype.itemsize)
+
+
+class DataLogger:
+    """
+    records every sample of the input callbacks of a TFH. The acquisition side costs one deque append per sample,
+    channels are mapped to their config keys in the file header. A channel appearing later (config reload) starts
+    a new file with an extended header
+    """
+    def __init__(self, tfh, directory="./logs", prefix="tfh", file_records=default_file_records,
+                 flush_interval=default_flush_interval):
+        self.tfh = tfh
+        self.directory = directory
+        self.prefix = prefix
+        self.file_records = file_records
+        self.flush_interval = flush_interval
+        self.queue = deque()
+        self.channels = []
+        # (uid, channel) → index into channels
+        self.channel_index = {}
+        self.log_file = None
+        self.files = []
+        self.samples_written = 0
+        self.batches = 0
+        self._file_no = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.add_channels(self.input_channels())
+        self.tfh.value_listeners.append(self.on_value)
+        self._thread = threading.Thread(target=self._run, name="tfh-data-logger", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self.on_value in self.tfh.value_listeners:
+            self.tfh.value_listeners.remove(self.on_value)
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def input_channels(self):
+        """
+        (uid, channel, config key) of all input channels, channels without config entry get an empty key
+        """
+        keys = {}
+        for device_key, entry in (self.tfh.config or {}).items():
+            if isinstance(entry, dict) and "input_device" in entry:
+                keys[(entry["input_device"], entry.get("input_channel", 0))] = device_key
+        channels = []
+        for uid, input_dev in list(self.tfh.inputs.items()):
+            for channel in range(getattr(input_dev, "input_cnt", 0)):
+                channels.append((uid, channel, keys.get((uid, channel), "")))
+        return channels
+
+    def add_channels(self, channels):
+        for uid, channel, key in channels:
+            if (uid, channel) not in self.channel_index:
+                self.channel_index[(uid, channel)] = len(self.channels)
+                self.channels.append({"uid": uid, "channel": channel, "key": key})
+
+    # callback thread side
+
+    def on_value(self, uid, channel, value, timestamp):
+        self.queue.append((timestamp, uid, channel, value))
+
+    # writer thread side
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+    def _open_file(self):
+        if self.log_file is not None:
+            self.log_file.close()
+        self._file_no += 1
+        path = os.path.join(self.directory, f"{self.prefix}_{strftime('%Y%m%d_%H%M%S')}_{self._file_no:04d}"
+                                            f"{file_suffix}")
+        self.log_file = LogFile(path, list(self.channels), self.file_records)
+        self.files.append(path)
+
+    def flush(self):
+        """
+        moves the queued samples into the log files, called by the writer thread
+        """
+        queue = self.queue
+        n = len(queue)
+        if not n:
+            return
+        samples = [queue.popleft() for _ in range(n)]
+        unknown = {(uid, channel) for _, uid, channel, _ in samples} - self.channel_index.keys()
+        if unknown:
+            self.add_channels(self.input_channels())
+            self.add_channels((uid, channel, "") for uid, channel in unknown)
+            # the header of the current file does not know the new channels
+            self._open_file()
+        index = self.channel_index
+        records = np.empty(n, dtype=record_dtype)
+        records["timestamp"] = [sample[0] for sample in samples]
+        records["channel"] = [index[(sample[1], sample[2])] for sample in samples]
+        records["value"] = [sample[3] for sample in samples]
+
+        written = 0
+        while written < n:
+            if self.log_file is None or not self.log_file.free():
+                self._open_file()
+            chunk = records[written:written + self.log_file.free()]
+            self.log_file.write(chunk)
+            written += len(chunk)
+        self.samples_written += n
+        self.batches += 1
+
+    def stats(self):
+        return {"samples_written": self.samples_written, "batches": self.batches, "queued": len(self.queue),
+                "files": list(self.files)}
+
+
+def read_header(path):
+    """
+    returns (header dict, header size, number of valid records) of a log file
+    """
+    with open(path, "rb") as log_file:
+        file_magic, header_size, record_size, count = struct.unpack(prefix_format, log_file.read(prefix_size))
+        if file_magic != magic or record_size != record_dtype.itemsize:
+            raise ValueError(f"{path} is no tfh log file")
+        header = json.loads(log_file.read(header_size - prefix_size).decode())
+    return header, header_size, count
+
+
+class LogReader:
+    """
+    streaming access to the log files of a file, a directory or a glob pattern in chronological order.
+    Records are read chunk wise as numpy arrays, with follow the files still being written are tailed
+    """
+    def __init__(self, source):
+        self.source = source
+
+    def files(self):
+        if os.path.isdir(self.source):
+            return sorted(glob.glob(os.path.join(self.source, f"*{file_suffix}")))
+        if os.path.isfile(self.source):
+            return [self.source]
+        return sorted(glob.glob(self.source))
+
+    def iter_chunks(self, chunk_size=65536, follow=False, poll_interval=0.5):
+        """
+        yields (channels, records) with channels the channel list of the file header and records a structured
+        array of at most chunk_size records
+        """
+        done = set()
+        while True:
+            pending = [path for path in self.files() if path not in done]
+            if not pending:
+                if not follow:
+                    return
+                sleep(poll_interval)
+                continue
+            for path in pending:
+                header, header_size, count = read_header(path)
+                position = 0
+                while True:
+                    if position < count:
+                        end = min(position + chunk_size, count)
+                        records = np.fromfile(path, dtype=record_dtype, count=end - position,
+                                              offset=header_size + position * record_dtype.itemsize)
+                        position = end
+                        yield header["channels"], records
+                        continue
+                    newer = path != self.files()[-1]
+                    _, _, count = read_header(path)
+                    if position < count:
+                        continue
+                    if not follow or newer:
+                        break
+                    sleep(poll_interval)
+                done.add(path)
+
+    def __iter__(self):
+        """
+        (timestamp, key, uid, channel, value) of every record
+        """
+        for channels, records in self.iter_chunks():
+            for timestamp, channel, value in records.tolist():
+                entry = channels[channel]
+                yield timestamp, entry["key"], entry["uid"], entry["channel"], value
+
+
+def export_csv(source, out):
+    """
+    writes all records of the log files as csv rows timestamp,key,uid,channel,value. out is a path or a file object
+    """
+    out_file = open(out, "w", newline="") if isinstance(out, str) else out
+    try:
+        writer = csv.writer(out_file)
+        writer.writerow(["timestamp", "key", "uid", "channel", "value"])
+        rows = 0
+        for channels, records in LogReader(source).iter_chunks():
+            labels = [(entry["key"], entry["uid"], entry["channel"]) for entry in channels]
+            writer.writerows((f"{timestamp:.6f}", *labels[channel], repr(value))
+                             for timestamp, channel, value in records.tolist())
+            rows += len(records)
+        return rows
+    finally:
+        if out_file is not out:
+            out_file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tools for the binary TFH data logs")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="export log files as csv")
+    export.add_argument("source", help="log file, directory or glob pattern")
+    export.add_argument("--out", default=None, help="csv file, stdout if omitted")
+    info = commands.add_parser("info", help="list log files with their channels and record counts")
+    info.add_argument("source", help="log file, directory or glob pattern")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        rows = export_csv(args.source, args.out or sys.stdout)
+        print(f"exported {rows} records", file=sys.stderr)
+    else:
+        for path in LogReader(args.source).files():
+            header, _, count = read_header(path)
+            channels = ", ".join(entry["key"] or f"{entry['uid']}/{entry['channel']}" for entry in header["channels"])
+            print(f"{path}: {count} records, channels {channels}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+from collections import namedtuple
+
+# an input bricklet described by its API instead of a hand written class, see TFH.device_class.
+# getter reads one channel (with the channel as first argument if channel_arg), all_getter all channels at once.
+# callback is (name of the CALLBACK_ constant without prefix, its configuration setter) or None for bricklets that are
+# only polled. Stored values are the API value times scale, in unit
+InputDescriptor = namedtuple("InputDescriptor", ["name", "device_type", "bricklet", "channels", "getter", "callback",
+                                                 "channel_arg", "all_getter", "scale", "unit", "default_period"],
+                             defaults=(False, None, 1, "", 500))
+
+# an output bricklet: modes maps the mode name to (setter, unit), the first mode is the default and config entries
+# select another one per UID with output_mode. setup lists (method, args) sent after the commanded values on every
+# configure, e.g. enabling the output. legacy_modes maps UIDs to the mode they were driven with before output_mode
+# existed, used for them if the config sets none
+OutputDescriptor = namedtuple("OutputDescriptor", ["name", "device_type", "bricklet", "channels", "modes",
+                                                   "channel_arg", "setup", "legacy_modes"],
+                              defaults=(False, (), {}))
+
+device_descriptors = [
+    InputDescriptor("AnalogInV3", 295, ("bricklet_analog_in_v3", "BrickletAnalogInV3"), 1, "get_voltage",
+                    ("VOLTAGE", "set_voltage_callback_configuration"), unit="mV"),
+    OutputDescriptor("AnalogOutV3", 2115, ("bricklet_analog_out_v3", "BrickletAnalogOutV3"), 1,
+                     {"voltage": ("set_output_voltage", "mV")}),
+    OutputDescriptor("IndustrialAnalogOutV2", 2116,
+                     ("bricklet_industrial_analog_out_v2", "BrickletIndustrialAnalogOutV2"), 1,
+                     {"voltage": ("set_voltage", "mV"), "current": ("set_current", "µA")},
+                     setup=(("set_enabled", (True,)), ("set_out_led_status_config", (0, 5000, 1))),
+                     legacy_modes={"27A7": "current"}),
+]
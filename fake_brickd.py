@@ -0,0 +1,578 @@
+"""
+Local stand-in for brickd speaking the TCP/IP protocol of the tinkerforge bindings, an IPConnection can connect to it
+like to a real brickd. It simulates any number of the bricklets TFH supports including their value callbacks,
+device disconnects / reconnects and connection drops, meant for load tests without hardware.
+
+    python -m <package>.fake_brickd --port 4223 --thermocouple 100 --quad-relay 20 --config-out json_files/sim.json
+"""
+import argparse
+import heapq
+import inspect
+import itertools
+import json
+import random
+import re
+import socket
+import struct
+import threading
+from functools import lru_cache
+from time import monotonic, sleep
+
+from tinkerforge.ip_connection import IPConnection, base58decode, base58encode, uid64_to_uid32
+from tinkerforge.ip_connection import pack_payload, unpack_payload
+
+from .tinkerforge_lib import load_bricklet
+
+FUNCTION_GET_IDENTITY = 255
+MASTER_BRICK = 13
+PORTS_PER_MASTER = 4
+
+_send_request = re.compile(r"send_request\(self, \w+\.FUNCTION_(\w+), \(.*?\), '([^']*)', (\d+), '([^']*)'\)")
+_callback_format = re.compile(r"callback_formats\[\w+\.CALLBACK_(\w+)\] = \((\d+), '([^']*)'\)")
+
+
+@lru_cache(maxsize=None)
+def binding_protocol(binding):
+    """
+    function id -> (name, request form, response form) and callback name -> (callback id, form),
+    parsed once from the source of the binding class
+    """
+    cls = load_bricklet(*binding)
+    source = inspect.getsource(cls)
+    functions = {}
+    for name, request_form, _, response_form in _send_request.findall(source):
+        functions[getattr(cls, f"FUNCTION_{name}")] = (name.lower(), request_form, response_form)
+    callbacks = {name: (getattr(cls, f"CALLBACK_{name}"), form) for name, _, form in _callback_format.findall(source)}
+    return functions, callbacks
+
+
+def zero_value(token):
+    count = int(token[:-1]) if len(token) > 1 else 1
+    kind = token[-1]
+    if kind == "s":
+        return ""
+    value = {"!": False, "c": "\0"}.get(kind, 0)
+    return [value] * count if count > 1 else value
+
+
+def decode_uid(uid):
+    value = base58decode(uid)
+    return uid64_to_uid32(value) if value > 0xFFFFFFFF else value
+
+
+class DeviceSpec:
+    """
+    simulation parameters of a device type. callback_configs maps the name of a callback configuration setter to
+    (callback name, per channel). signal is (start, step) of the random walk of analog values, None for digital ones
+    """
+    def __init__(self, name, binding, channels, config_type=None, callback_configs=None, signal=None, getters=None):
+        self.name = name
+        self.binding = binding
+        self.channels = channels
+        self.config_type = config_type
+        self.callback_configs = callback_configs or {}
+        self.signal = signal
+        # getter name -> channel given as first argument, the getter returns the simulated value
+        self.getters = getters or {}
+
+
+device_specs = {
+    MASTER_BRICK: DeviceSpec("master", ("brick_master", "BrickMaster"), 0),
+    2109: DeviceSpec("thermocouple", ("bricklet_thermocouple_v2", "BrickletThermocoupleV2"), 1, "thermocouple",
+                     {"set_temperature_callback_configuration": ("TEMPERATURE", False)}, (2500, 20),
+                     {"get_temperature": False}),
+    2121: DeviceSpec("dual_analog_in", ("bricklet_industrial_dual_analog_in_v2", "BrickletIndustrialDualAnalogInV2"),
+                     2, "pressure",
+                     {"set_all_voltages_callback_configuration": ("ALL_VOLTAGES", False),
+                      "set_voltage_callback_configuration": ("VOLTAGE", True)}, (5000, 10),
+                     {"get_voltage": True}),
+    2120: DeviceSpec("dual_020ma", ("bricklet_industrial_dual_0_20ma_v2", "BrickletIndustrialDual020mAV2"), 2,
+                     "pressure", {"set_current_callback_configuration": ("CURRENT", True)}, (12000000, 10000),
+                     {"get_current": True}),
+    2100: DeviceSpec("digital_in", ("bricklet_industrial_digital_in_4_v2", "BrickletIndustrialDigitalIn4V2"), 4,
+                     "analytic",
+                     {"set_value_callback_configuration": ("VALUE", True),
+                      "set_all_value_callback_configuration": ("ALL_VALUE", False)}),
+    2124: DeviceSpec("digital_out", ("bricklet_industrial_digital_out_4_v2", "BrickletIndustrialDigitalOut4V2"), 4,
+                     "valve"),
+    284: DeviceSpec("dual_relay", ("bricklet_industrial_dual_relay", "BrickletIndustrialDualRelay"), 2, "valve"),
+    2102: DeviceSpec("quad_relay", ("bricklet_industrial_quad_relay_v2", "BrickletIndustrialQuadRelayV2"), 4, "valve"),
+    2116: DeviceSpec("analog_out", ("bricklet_industrial_analog_out_v2", "BrickletIndustrialAnalogOutV2"), 1, "valve"),
+    295: DeviceSpec("analog_in_v3", ("bricklet_analog_in_v3", "BrickletAnalogInV3"), 1, "pressure",
+                    {"set_voltage_callback_configuration": ("VOLTAGE", False)}, (5000, 10), {"get_voltage": False}),
+    2115: DeviceSpec("analog_out_v3", ("bricklet_analog_out_v3", "BrickletAnalogOutV3"), 1, "valve"),
+}
+
+
+class CallbackConfig:
+    def __init__(self, callback_id, form, channel, period, value_has_to_change, option="x", minimum=0, maximum=0):
+        self.callback_id = callback_id
+        self.form = form
+        self.channel = channel
+        self.period = period
+        self.value_has_to_change = value_has_to_change
+        self.option = option
+        self.minimum = minimum
+        self.maximum = maximum
+        self.last_values = None
+
+    def threshold_passed(self, value):
+        if self.option == "o":
+            return value < self.minimum or value > self.maximum
+        if self.option == "i":
+            return self.minimum <= value <= self.maximum
+        if self.option == "<":
+            return value < self.minimum
+        if self.option == ">":
+            return value > self.minimum
+        return True
+
+
+class SimulatedDevice:
+    def __init__(self, uid, device_identifier, connected_uid, position):
+        self.uid = uid
+        self.uid32 = decode_uid(uid)
+        self.device_identifier = device_identifier
+        self.connected_uid = connected_uid
+        self.position = position
+        self.spec = device_specs[device_identifier]
+        self.present = True
+        # pulses per second seen by the edge counters of digital inputs
+        self.pulse_rate = 250.0
+        # bumped on every callback reconfiguration, invalidates scheduled callback entries
+        self.generation = 0
+        self.reset()
+
+    def reset(self):
+        """
+        state after a power cycle: no setter state and all callbacks off
+        """
+        self.state = {}
+        self.callbacks = {}
+        # channel → monotonic time of the last counter reset, the count follows from pulse_rate
+        self.edge_counters = {}
+        self.generation += 1
+        start = self.spec.signal[0] if self.spec.signal else False
+        self.values = [start] * self.spec.channels
+
+    def sample(self):
+        """
+        advances the simulated signals by one step
+        """
+        if self.spec.signal:
+            step = self.spec.signal[1]
+            self.values = [value + random.randint(-step, step) for value in self.values]
+        else:
+            self.values = [not value if random.random() < 0.05 else value for value in self.values]
+
+    def identity(self):
+        return (self.uid, self.connected_uid, self.position, [1, 0, 0], [2, 0, 0], self.device_identifier)
+
+    def handle_request(self, function_id, payload):
+        """
+        returns (error code, response payload) of a request to this device
+        """
+        if function_id == FUNCTION_GET_IDENTITY:
+            return 0, pack_payload(self.identity(), "8s 8s c 3B 3B H")
+        functions, callbacks = binding_protocol(self.spec.binding)
+        if function_id not in functions:
+            return 2, b""
+        name, request_form, response_form = functions[function_id]
+        if not request_form:
+            args = ()
+        elif len(request_form.split(" ")) == 1:
+            args = (unpack_payload(payload, request_form),)
+        else:
+            args = tuple(unpack_payload(payload, request_form))
+
+        if name == "set_edge_count_configuration":
+            self.edge_counters[args[0]] = monotonic()
+        if name == "get_edge_count":
+            return 0, pack_payload((self.edge_count(*args),), response_form)
+        if name.startswith("set_"):
+            entries = self.state.setdefault(name[4:], {})
+            entries[None] = args
+            if args and isinstance(args[0], (int, str)):
+                entries[args[0]] = args
+        if name in self.spec.callback_configs:
+            self.configure_callback(name, args, callbacks)
+        if not response_form:
+            return 0, b""
+
+        tokens = response_form.split(" ")
+        if name in self.spec.getters:
+            # polled channels have no callbacks advancing their signal
+            self.sample()
+            channel = args[0] if self.spec.getters[name] else 0
+            return 0, pack_payload((self.values[channel],), response_form)
+        entries = self.state.get(name[4:], {})
+        stored = entries.get(args[0]) if args else entries.get(None)
+        response = tuple(stored[len(args):]) if stored else ()
+        if len(response) != len(tokens):
+            response = tuple(zero_value(token) for token in tokens)
+        return 0, pack_payload(response, response_form)
+
+    def edge_count(self, channel, reset_counter):
+        now = monotonic()
+        count = int((now - self.edge_counters.setdefault(channel, now)) * self.pulse_rate) & 0xFFFFFFFF
+        if reset_counter:
+            self.edge_counters[channel] = now
+        return count
+
+    def configure_callback(self, name, args, callbacks):
+        callback_name, per_channel = self.spec.callback_configs[name]
+        callback_id, form = callbacks[callback_name]
+        channel = args[0] if per_channel else None
+        config_args = args[1:] if per_channel else args
+        self.callbacks[(callback_id, channel)] = CallbackConfig(callback_id, form, channel, *config_args)
+        self.generation += 1
+
+    def callback_payload(self, config):
+        """
+        payload of a due callback or None if value has to change / the threshold suppresses it
+        """
+        tokens = config.form.split(" ")
+        if config.channel is not None:
+            value = self.values[config.channel]
+            if not config.threshold_passed(value):
+                return None
+            changed = config.last_values is not None and config.last_values != value
+            if config.value_has_to_change and not changed and config.last_values is not None:
+                return None
+            config.last_values = value
+            data = (config.channel, changed, value) if len(tokens) == 3 else (config.channel, value)
+        else:
+            values = list(self.values)
+            if config.value_has_to_change and config.last_values == values:
+                return None
+            previous = config.last_values or values
+            config.last_values = values
+            if len(tokens) == 2:
+                data = ([a != b for a, b in zip(values, previous)], values)
+            elif len(tokens[0]) > 1:
+                data = (values,)
+            else:
+                data = (values[0],)
+        return pack_payload(data, config.form)
+
+
+class FakeBrickd:
+    """
+    threaded TCP server, every client gets the enumerate and value callbacks of all devices like from brickd.
+    period_override (ms) replaces the callback periods configured by the client, e.g. for stress tests
+    """
+    def __init__(self, host="127.0.0.1", port=0, period_override=None, seed=None):
+        self.host = host
+        self.port = port
+        self.period_override = period_override
+        self.devices = {}
+        self.uid32_map = {}
+        self.clients = set()
+        self.clients_lock = threading.Lock()
+        self.running = False
+        self.callbacks_sent = 0
+        self.requests_handled = 0
+        self._uid_counter = itertools.count(100000)
+        self._masters = []
+        # set whenever callbacks are reconfigured or devices come and go
+        self._wakeup = threading.Event()
+        self._threads = []
+        random.seed(seed)
+
+    # device setup
+
+    def _next_uid(self):
+        return base58encode(next(self._uid_counter))
+
+    def _add(self, device_identifier, uid, connected_uid, position):
+        device = SimulatedDevice(uid, device_identifier, connected_uid, position)
+        self.devices[uid] = device
+        self.uid32_map[device.uid32] = device
+        return device
+
+    def add_device(self, device_identifier, uid=None):
+        """
+        adds a bricklet to the next free port of a master brick, masters are added as needed
+        """
+        if device_identifier not in device_specs or device_identifier == MASTER_BRICK:
+            raise ValueError(f"device identifier {device_identifier} can not be simulated")
+        master = self._masters[-1] if self._masters else None
+        if master is None or len(master[1]) >= PORTS_PER_MASTER:
+            master = (self._add(MASTER_BRICK, self._next_uid(), "0", "0"), [])
+            self._masters.append(master)
+        position = "abcd"[len(master[1])]
+        device = self._add(device_identifier, uid or self._next_uid(), master[0].uid, position)
+        master[1].append(device)
+        self._announce([master[0], device], IPConnection.ENUMERATION_TYPE_CONNECTED)
+        return device.uid
+
+    def add_devices(self, device_identifier, count):
+        return [self.add_device(device_identifier) for _ in range(count)]
+
+    def children(self, uid):
+        return [device for device in self.devices.values() if device.connected_uid == uid]
+
+    def make_config(self):
+        """
+        TFH config with one entry per channel of every simulated device
+        """
+        config = {}
+        for device in self.devices.values():
+            spec = device.spec
+            if spec.config_type is None:
+                continue
+            for channel in range(spec.channels):
+                key = f"{spec.name}_{device.uid}_{channel}"
+                entry = {"type": spec.config_type}
+                if spec.config_type == "valve":
+                    entry.update(output_device=device.uid, output_channel=channel)
+                else:
+                    entry.update(input_device=device.uid, input_channel=channel)
+                if spec.config_type == "thermocouple":
+                    entry["tc_type"] = "K"
+                if device.device_identifier == 2116:
+                    # multi-mode outputs without an output_mode warn on every start
+                    entry["output_mode"] = "voltage"
+                config[key] = entry
+        return config
+
+    # disconnect simulation
+
+    def disconnect_device(self, uid):
+        """
+        unplugs a device, for a master brick all of its bricklets are lost as well
+        """
+        lost = [self.devices[uid]] + self.children(uid)
+        for device in lost:
+            device.present = False
+        self._announce(lost, IPConnection.ENUMERATION_TYPE_DISCONNECTED)
+
+    def reconnect_device(self, uid):
+        """
+        plugs a device back in, it comes back in power on state with its callbacks off
+        """
+        returning = [self.devices[uid]] + self.children(uid)
+        for device in returning:
+            device.reset()
+            device.present = True
+        self._announce(returning, IPConnection.ENUMERATION_TYPE_CONNECTED)
+
+    def flap(self, uid, downtime=1.0):
+        self.disconnect_device(uid)
+        threading.Timer(downtime, self.reconnect_device, (uid,)).start()
+
+    def drop_connections(self):
+        """
+        closes all client sockets like a brickd restart, clients with auto reconnect come back on their own
+        """
+        with self.clients_lock:
+            clients, self.clients = self.clients, set()
+        for client, _ in clients:
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client.close()
+
+    def start_chaos(self, interval, downtime=1.0):
+        """
+        every interval seconds a random master brick is unplugged for downtime seconds
+        """
+        def chaos():
+            while self.running:
+                sleep(interval)
+                if self.running and self._masters:
+                    self.flap(random.choice(self._masters)[0].uid, downtime)
+        self._start_thread(chaos)
+
+    # server
+
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def start(self):
+        self.server = socket.create_server((self.host, self.port))
+        self.server.settimeout(0.2)
+        self.port = self.server.getsockname()[1]
+        self.running = True
+        self._wakeup.set()
+        self._start_thread(self._accept_loop)
+        self._start_thread(self._callback_loop)
+        return self
+
+    def stop(self):
+        self.running = False
+        self._wakeup.set()
+        self.drop_connections()
+        self.server.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                client, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            entry = (client, threading.Lock())
+            with self.clients_lock:
+                self.clients.add(entry)
+            self._start_thread(self._client_loop, entry)
+
+    def _send(self, entry, packet):
+        client, lock = entry
+        try:
+            with lock:
+                client.sendall(packet)
+        except OSError:
+            with self.clients_lock:
+                self.clients.discard(entry)
+
+    def _broadcast(self, packet):
+        with self.clients_lock:
+            clients = list(self.clients)
+        for entry in clients:
+            self._send(entry, packet)
+
+    @staticmethod
+    def _packet(uid32, function_id, payload, sequence_options=0, error_code=0):
+        return struct.pack("<IBBBB", uid32, 8 + len(payload), function_id, sequence_options,
+                           error_code << 6) + payload
+
+    def _enumerate_packet(self, device, enumeration_type):
+        if enumeration_type == IPConnection.ENUMERATION_TYPE_DISCONNECTED:
+            data = (device.uid, "", "\0", [0, 0, 0], [0, 0, 0], 0, enumeration_type)
+        else:
+            data = device.identity() + (enumeration_type,)
+        payload = pack_payload(data, "8s 8s c 3B 3B H B")
+        return self._packet(0, IPConnection.CALLBACK_ENUMERATE, payload)
+
+    def _announce(self, devices, enumeration_type):
+        if not self.running:
+            return
+        for device in devices:
+            self._broadcast(self._enumerate_packet(device, enumeration_type))
+        self._wakeup.set()
+
+    def _client_loop(self, entry):
+        client = entry[0]
+        pending = b""
+        while self.running:
+            try:
+                data = client.recv(8192)
+            except OSError:
+                break
+            if not data:
+                break
+            pending += data
+            while len(pending) >= 8 and len(pending) >= pending[4]:
+                length = pending[4]
+                packet, pending = pending[:length], pending[length:]
+                self._handle_packet(entry, packet)
+        with self.clients_lock:
+            self.clients.discard(entry)
+
+    def _handle_packet(self, entry, packet):
+        uid32, _, function_id, sequence_options, _ = struct.unpack("<IBBBB", packet[:8])
+        if uid32 == IPConnection.BROADCAST_UID:
+            if function_id == IPConnection.FUNCTION_ENUMERATE:
+                for device in list(self.devices.values()):
+                    if device.present:
+                        self._send(entry, self._enumerate_packet(device, IPConnection.ENUMERATION_TYPE_AVAILABLE))
+            # disconnect probes need no answer
+            return
+        device = self.uid32_map.get(uid32)
+        if device is None or not device.present:
+            # like brickd: no answer, the client runs into its timeout
+            return
+        generation = device.generation
+        error_code, payload = device.handle_request(function_id, packet[8:])
+        self.requests_handled += 1
+        if sequence_options & 0x08:
+            self._send(entry, self._packet(uid32, function_id, payload if error_code == 0 else b"",
+                                           sequence_options, error_code))
+        if device.generation != generation:
+            self._wakeup.set()
+
+    def _callback_loop(self):
+        """
+        one heap for all configured callbacks of all devices, entries of reconfigured devices are dropped lazily
+        """
+        heap = []
+        scheduled = set()
+        counter = itertools.count()
+        while self.running:
+            if self._wakeup.is_set():
+                self._wakeup.clear()
+                now = monotonic()
+                for device in list(self.devices.values()):
+                    for key, config in list(device.callbacks.items()):
+                        marker = (device.uid, key, device.generation)
+                        if device.present and config.period and marker not in scheduled:
+                            scheduled.add(marker)
+                            heapq.heappush(heap, (now, next(counter), device, key, device.generation))
+
+            while heap and heap[0][0] <= monotonic():
+                due, _, device, key, generation = heapq.heappop(heap)
+                config = device.callbacks.get(key)
+                if config is None or generation != device.generation or not device.present:
+                    scheduled.discard((device.uid, key, generation))
+                    continue
+                device.sample()
+                payload = device.callback_payload(config)
+                if payload is not None:
+                    self._broadcast(self._packet(device.uid32, config.callback_id, payload))
+                    self.callbacks_sent += 1
+                period = (self.period_override or config.period) / 1000
+                heapq.heappush(heap, (max(due + period, monotonic() - period), next(counter), device, key,
+                                      generation))
+
+            timeout = heap[0][0] - monotonic() if heap else 0.5
+            if timeout > 0:
+                self._wakeup.wait(min(timeout, 0.5))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="local brickd stand-in with simulated bricklets")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4223)
+    parser.add_argument("--period", type=int, default=None, help="override of all callback periods in ms")
+    parser.add_argument("--chaos", type=float, default=None,
+                        help="unplug a random master brick every CHAOS seconds")
+    parser.add_argument("--downtime", type=float, default=1.0, help="downtime of a chaos disconnect in seconds")
+    parser.add_argument("--config-out", default=None, help="write a matching TFH config json to this path")
+    for device_identifier, spec in device_specs.items():
+        if device_identifier != MASTER_BRICK:
+            parser.add_argument(f"--{spec.name.replace('_', '-')}", type=int, default=0, dest=spec.name,
+                                help=f"number of simulated {spec.binding[1]}")
+    args = parser.parse_args()
+
+    server = FakeBrickd(args.host, args.port, args.period)
+    for device_identifier, spec in device_specs.items():
+        if device_identifier != MASTER_BRICK:
+            server.add_devices(device_identifier, getattr(args, spec.name))
+    if args.config_out:
+        with open(args.config_out, "w") as config_file:
+            json.dump(server.make_config(), config_file, indent=2)
+    server.start()
+    print(f"simulating {len(server.devices)} devices on {server.host}:{server.port}")
+    if args.chaos:
+        server.start_chaos(args.chaos, args.downtime)
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import numpy as np
+from time import time
+
+default_history_length = 10000
+
+
+class ChannelHistory:
+    """
+    preallocated ring buffer of the (timestamp, value) samples of one channel, timestamps are unix seconds.
+    Queries return numpy views where the requested samples are contiguous in the buffer and a single copy
+    where they wrap around, ordered oldest to newest
+    """
+    def __init__(self, length=default_history_length):
+        self.length = length
+        self.timestamps = np.full(length, np.nan)
+        self.values = np.full(length, np.nan)
+        # total number of samples ever appended, the write position is count % length
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.length)
+
+    def append(self, value, timestamp=None):
+        index = self.count % self.length
+        self.timestamps[index] = time() if timestamp is None else timestamp
+        self.values[index] = value
+        self.count += 1
+
+    def clear(self):
+        self.count = 0
+
+    def _segments(self, n, buffer):
+        """
+        the last n entries of buffer as one or two views in chronological order
+        """
+        end = self.count % self.length
+        start = end - n
+        if start >= 0:
+            return (buffer[start:end],)
+        return buffer[start:], buffer[:end]
+
+    def _take(self, n, buffer):
+        segments = self._segments(n, buffer)
+        return segments[0] if len(segments) == 1 else np.concatenate(segments)
+
+    def last(self, n=None):
+        """
+        timestamps and values of the last n samples, all stored samples if n is None
+        """
+        n = len(self) if n is None else min(n, len(self))
+        return self._take(n, self.timestamps), self._take(n, self.values)
+
+    def count_since(self, t):
+        n = 0
+        for segment in self._segments(len(self), self.timestamps):
+            n += len(segment) - int(np.searchsorted(segment, t, side="left"))
+        return n
+
+    def since(self, t):
+        """
+        timestamps and values of all samples taken at or after the unix time t
+        """
+        return self.last(self.count_since(t))
+
+    def _window(self, n, since):
+        if since is not None:
+            n = self.count_since(since)
+        n = len(self) if n is None else min(n, len(self))
+        return self._take(n, self.values)
+
+    def mean(self, n=None, since=None):
+        values = self._window(n, since)
+        return float(np.nanmean(values)) if len(values) else float("nan")
+
+    def min(self, n=None, since=None):
+        values = self._window(n, since)
+        return float(np.nanmin(values)) if len(values) else float("nan")
+
+    def max(self, n=None, since=None):
+        values = self._window(n, since)
+        return float(np.nanmax(values)) if len(values) else float("nan")
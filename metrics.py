@@ -0,0 +1,216 @@
+import os
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds in seconds, the last bucket is +Inf
+default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {"buckets": dict(zip([*self.buckets, float("inf")], self.counts)), "sum": self.sum,
+                "count": self.count}
+
+
+class Metrics:
+    """
+    hot path instrumentation of a TFH, only exists while enabled so disabled instrumentation costs nothing but a
+    None check per cycle. Callbacks are counted per input channel through the value listeners of the TFH,
+    counters the TFH keeps anyway (bus calls, timeouts, reconnects) are only read when a snapshot is taken
+    """
+    phases = ("inputs", "controls", "outputs")
+
+    def __init__(self, tfh, buckets=default_buckets):
+        self.tfh = tfh
+        self.buckets = buckets
+        # (uid, channel) -> [count, last timestamp, Histogram of the inter-arrival times]
+        self.callbacks = {}
+        self.phase_times = {phase: Histogram(buckets) for phase in self.phases}
+        self.cycles = 0
+        self._http = None
+
+    def attach(self):
+        self.tfh.value_listeners.append(self.on_value)
+
+    def detach(self):
+        if self.on_value in self.tfh.value_listeners:
+            self.tfh.value_listeners.remove(self.on_value)
+        self.stop_http()
+
+    def on_value(self, uid, channel, value, timestamp):
+        entry = self.callbacks.get((uid, channel))
+        if entry is None:
+            self.callbacks[(uid, channel)] = [1, timestamp, Histogram(self.buckets)]
+            return
+        entry[0] += 1
+        entry[2].observe(timestamp - entry[1])
+        entry[1] = timestamp
+
+    def observe_cycle(self, inputs, controls, outputs):
+        self.cycles += 1
+        self.phase_times["inputs"].observe(inputs)
+        self.phase_times["controls"].observe(controls)
+        self.phase_times["outputs"].observe(outputs)
+
+    def snapshot(self):
+        tfh = self.tfh
+        outputs = {}
+        for uid, output_dev in list(tfh.outputs.items()):
+            if not hasattr(output_dev, "bus_calls_sent"):
+                continue
+            outputs[uid] = {"bus_calls": output_dev.bus_calls_sent,
+                            "bus_calls_suppressed": output_dev.bus_calls_suppressed,
+                            "write_failures": output_dev.write_failures}
+        return {
+            "callbacks": {f"{uid}/{channel}": {"count": count, "interarrival": histogram.snapshot()}
+                          for (uid, channel), (count, _, histogram) in list(self.callbacks.items())},
+            "cycles": self.cycles,
+            "phases": {phase: histogram.snapshot() for phase, histogram in self.phase_times.items()},
+            "outputs": outputs,
+            "timeouts": dict(tfh.event_counters["timeouts"]),
+            "reconnects": dict(tfh.event_counters["reconnects"]),
+            "disconnects": dict(tfh.event_counters["disconnects"]),
+            "loop": tfh.get_loop_stats(),
+            "recovery": tfh.get_recovery_stats(),
+            "output_dispatch": tfh.get_output_dispatch_stats(),
+            "failsafe": tfh.get_failsafe_stats(),
+        }
+
+    def prometheus_text(self):
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def histogram(name, labels, data):
+            cumulative = 0
+            for bound, count in data["buckets"].items():
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{name}_bucket{{{labels}le="{le}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{labels.rstrip(',')}}} {data['sum']}")
+            lines.append(f"{name}_count{{{labels.rstrip(',')}}} {data['count']}")
+
+        metric("tfh_callbacks_total", "counter", "samples received from the bricklet callbacks")
+        for key, data in snapshot["callbacks"].items():
+            uid, channel = key.split("/")
+            lines.append(f'tfh_callbacks_total{{uid="{uid}",channel="{channel}"}} {data["count"]}')
+        metric("tfh_callback_interarrival_seconds", "histogram", "time between two samples of a channel")
+        for key, data in snapshot["callbacks"].items():
+            uid, channel = key.split("/")
+            histogram("tfh_callback_interarrival_seconds", f'uid="{uid}",channel="{channel}",',
+                      data["interarrival"])
+
+        metric("tfh_cycle_phase_seconds", "histogram", "duration of the main loop phases")
+        for phase, data in snapshot["phases"].items():
+            histogram("tfh_cycle_phase_seconds", f'phase="{phase}",', data)
+
+        for field, name, help_text in (("bus_calls", "tfh_output_bus_calls_total", "bus calls sent to outputs"),
+                                       ("bus_calls_suppressed", "tfh_output_bus_calls_suppressed_total",
+                                        "output bus calls saved by the change tracking"),
+                                       ("write_failures", "tfh_output_write_failures_total",
+                                        "failed output writes")):
+            metric(name, "counter", help_text)
+            for uid, data in snapshot["outputs"].items():
+                lines.append(f'{name}{{uid="{uid}"}} {data[field]}')
+
+        for field, help_text in (("timeouts", "input timeouts"), ("reconnects", "device reconnects"),
+                                 ("disconnects", "device disconnects")):
+            metric(f"tfh_{field}_total", "counter", help_text)
+            for uid, count in snapshot[field].items():
+                lines.append(f'tfh_{field}_total{{uid="{uid}"}} {count}')
+
+        metric("tfh_recovery_restore_seconds", "gauge", "duration of the last restore after a reconnect")
+        for uid, data in snapshot["recovery"].items():
+            lines.append(f'tfh_recovery_restore_seconds{{uid="{uid}"}} {data["restore"]}')
+        metric("tfh_recovery_downtime_seconds", "gauge", "time from the last loss of a device to its restore")
+        for uid, data in snapshot["recovery"].items():
+            if data["downtime"] is not None:
+                lines.append(f'tfh_recovery_downtime_seconds{{uid="{uid}"}} {data["downtime"]}')
+
+        for field, name, kind, help_text in (
+                ("latency_last", "tfh_output_write_latency_seconds", "gauge", "duration of the last output write"),
+                ("latency_max", "tfh_output_write_latency_max_seconds", "gauge", "longest output write"),
+                ("deadline_misses", "tfh_output_deadline_misses_total", "counter",
+                 "output writes exceeding the write deadline"),
+                ("quarantined", "tfh_output_quarantined", "gauge", "1 while an output is quarantined")):
+            metric(name, kind, help_text)
+            for uid, data in snapshot["output_dispatch"].items():
+                lines.append(f'{name}{{uid="{uid}"}} {float(data[field])}')
+
+        failsafe = snapshot["failsafe"]
+        metric("tfh_failsafe_trips_total", "counter", "inputs declared lost by the failsafe watchdog")
+        lines.append(f"tfh_failsafe_trips_total {failsafe['trips']}")
+        metric("tfh_failsafe_budget_exceeded_total", "counter",
+               "safe states confirmed later than the failsafe budget")
+        lines.append(f"tfh_failsafe_budget_exceeded_total {failsafe['budget_exceeded']}")
+        metric("tfh_failsafe_reaction_max_seconds", "gauge", "longest time from an input loss to its safe state")
+        lines.append(f"tfh_failsafe_reaction_max_seconds {failsafe['reaction_max']}")
+        metric("tfh_failsafe_reaction_seconds", "gauge", "time from the last loss of an input to its safe state")
+        for uid, data in failsafe["inputs"].items():
+            if data["reaction"] is not None:
+                lines.append(f'tfh_failsafe_reaction_seconds{{uid="{uid}"}} {data["reaction"]}')
+
+        loop = snapshot["loop"]
+        metric("tfh_loop_cycles_total", "counter", "main loop cycles")
+        lines.append(f"tfh_loop_cycles_total {loop['cycles']}")
+        metric("tfh_loop_overruns_total", "counter", "main loop cycles exceeding the period")
+        lines.append(f"tfh_loop_overruns_total {loop['overruns']}")
+        metric("tfh_loop_jitter_max_seconds", "gauge", "largest delay of a cycle start")
+        lines.append(f"tfh_loop_jitter_max_seconds {loop['jitter_max']}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """
+        writes the prometheus text format atomically, e.g. for the node exporter textfile collector
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as metrics_file:
+            metrics_file.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+    def serve_http(self, port, host="127.0.0.1"):
+        """
+        serves the prometheus text format on http://host:port/metrics from a daemon thread. There is no default
+        port, the common exporter ports (e.g. 9100 of the node exporter) are usually taken on the same host
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        self._http = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._http.serve_forever, daemon=True).start()
+        return self._http.server_address[1]
+
+    def stop_http(self):
+        if self._http is not None:
+            self._http.shutdown()
+            self._http.server_close()
+            self._http = None
@@ -0,0 +1,217 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from threading import Lock
+from time import monotonic, perf_counter
+
+# writes running at the same time, each blocked bricklet only occupies one of them
+default_workers = 8
+# seconds a write may take, a slower write counts as failed and its device as not responding
+default_deadline = 0.25
+# consecutive failed writes after which a device is quarantined
+quarantine_after = 3
+# seconds until the first retry of a quarantined device, doubled with every failed retry up to backoff_max
+backoff_initial = 0.5
+backoff_max = 30.0
+
+
+class DeviceDispatch:
+    """
+    write state and latency statistics of one output device
+    """
+    __slots__ = ("uid", "future", "started", "failures", "retry_at", "backoff", "writes", "latency_total",
+                 "latency_max", "latency_last", "deadline_misses", "quarantines", "followup")
+
+    def __init__(self, uid):
+        self.uid = uid
+        self.future = None
+        self.started = 0.0
+        self.failures = 0
+        # monotonic time before which a quarantined device is not written to, 0 if not quarantined
+        self.retry_at = 0.0
+        self.backoff = backoff_initial
+        self.writes = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_last = 0.0
+        self.deadline_misses = 0
+        self.quarantines = 0
+        # Future of a confirmed write requested by write_now while another write was in flight
+        self.followup = None
+
+    def stats(self):
+        return {"writes": self.writes, "latency_last": self.latency_last, "latency_max": self.latency_max,
+                "latency_mean": self.latency_total / self.writes if self.writes else 0.0,
+                "deadline_misses": self.deadline_misses, "failures": self.failures,
+                "quarantined": bool(self.retry_at), "quarantines": self.quarantines}
+
+
+class OutputDispatcher:
+    """
+    runs the bus writes of the output devices on a thread pool so a bricklet that does not answer only blocks its own
+    write instead of the main loop. A device has at most one write in flight, values changed meanwhile are written by
+    the first pass after it finished. Devices failing quarantine_after times in a row are skipped and retried with
+    exponential backoff
+    """
+    def __init__(self, workers=default_workers, deadline=default_deadline):
+        self.deadline = deadline
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tfh-output")
+        self.states = {}
+        # dispatch runs in the main loop, write_now in the failsafe watchdog
+        self._lock = Lock()
+
+    def state(self, uid):
+        state = self.states.get(uid)
+        if state is None:
+            state = self.states[uid] = DeviceDispatch(uid)
+        return state
+
+    def busy(self, uid):
+        state = self.states.get(uid)
+        return state is not None and state.future is not None and not state.future.done()
+
+    def overdue(self, uid):
+        """
+        True if the write in flight of the device already took longer than the deadline
+        """
+        return self.busy(uid) and perf_counter() - self.states[uid].started > self.deadline
+
+    def dispatch(self, output_dev, acknowledged=False):
+        """
+        called by the main loop once per output pass and never blocks. Returns the Future of the started write,
+        None if there was nothing to send, or the reason "busy" / "quarantined" why the device was skipped
+        """
+        with self._lock:
+            state = self.states.get(output_dev.uid) or self.state(output_dev.uid)
+            if state.future is not None:
+                if not state.future.done():
+                    return "busy"
+                state.future = None
+            if state.retry_at and monotonic() < state.retry_at:
+                return "quarantined"
+            dirty = output_dev.dirty_channels()
+            if not dirty:
+                # nothing goes to the bus, only the bookkeeping of set_outputs
+                output_dev.set_outputs(acknowledged, dirty)
+                return None
+            state.started = perf_counter()
+            state.future = self.executor.submit(self._write, state, output_dev, acknowledged)
+            return state.future
+
+    def write_now(self, output_dev):
+        """
+        starts a confirmed write of the changed channels right away, also for a quarantined device, and returns its
+        Future. With a write in flight the Future of a follow-up write is returned, run as soon as that one finished
+        """
+        with self._lock:
+            state = self.state(output_dev.uid)
+            if state.future is not None and not state.future.done():
+                if state.followup is None:
+                    state.followup = Future()
+                    state.followup.set_running_or_notify_cancel()
+                return state.followup
+            if not output_dev.dirty_channels():
+                future = Future()
+                future.set_result(None)
+                return future
+            state.started = perf_counter()
+            state.future = self.executor.submit(self._write, state, output_dev, True)
+            return state.future
+
+    def restore(self, output_dev):
+        """
+        runs output_dev.restore (configuration and last commanded values after a reconnect) as the write of the
+        device: after the write in flight, if any, and before the next one. Returns its Future, which fails with
+        the exception of restore
+        """
+        with self._lock:
+            state = self.state(output_dev.uid)
+            previous = state.future
+            state.future = self.executor.submit(self._restore, state, output_dev, previous)
+            return state.future
+
+    def _restore(self, state, output_dev, previous):
+        if previous is not None:
+            wait([previous])
+        state.started = perf_counter()
+        try:
+            output_dev.restore()
+        finally:
+            self._followups(state, output_dev)
+
+    def _write(self, state, output_dev, acknowledged):
+        try:
+            self._send(state, output_dev, acknowledged)
+        finally:
+            self._followups(state, output_dev)
+
+    def _followups(self, state, output_dev):
+        """
+        confirmed writes requested by write_now while the device was busy
+        """
+        while True:
+            with self._lock:
+                followup, state.followup = state.followup, None
+            if followup is None:
+                break
+            state.started = perf_counter()
+            try:
+                self._send(state, output_dev, True)
+            except Exception as exp:
+                followup.set_exception(exp)
+            else:
+                followup.set_result(None)
+
+    def _send(self, state, output_dev, acknowledged):
+        try:
+            output_dev.set_outputs(acknowledged)
+        except Exception as exp:
+            self._finished(state, perf_counter() - state.started, False)
+            output_dev.write_failures += 1
+            print(f"writing to output {output_dev.uid} - {type(output_dev).__name__} failed {exp}")
+            raise
+        latency = perf_counter() - state.started
+        self._finished(state, latency, latency <= self.deadline)
+
+    def _finished(self, state, latency, ok):
+        state.writes += 1
+        state.latency_last = latency
+        state.latency_total += latency
+        state.latency_max = max(state.latency_max, latency)
+        if latency > self.deadline:
+            state.deadline_misses += 1
+        if ok:
+            if state.retry_at:
+                print(f"output {state.uid} responding again after {state.quarantines} quarantine(s)")
+            state.failures = 0
+            state.retry_at = 0.0
+            state.backoff = backoff_initial
+            return
+        state.failures += 1
+        if state.failures >= quarantine_after:
+            state.quarantines += 1
+            state.retry_at = monotonic() + state.backoff
+            print(f"output {state.uid} quarantined after {state.failures} failed or late writes, "
+                  f"retrying in {state.backoff:.1f} s")
+            state.backoff = min(state.backoff * 2, backoff_max)
+
+    def release(self, uid=None):
+        """
+        lifts the quarantine of a device (e.g. after it reconnected), of all devices if uid is None
+        """
+        states = list(self.states.values()) if uid is None else [self.states[uid]] if uid in self.states else []
+        for state in states:
+            state.failures = 0
+            state.retry_at = 0.0
+            state.backoff = backoff_initial
+
+    def wait(self, timeout=None):
+        """
+        waits for the writes in flight, returns True if all of them finished
+        """
+        futures = [state.future for state in list(self.states.values()) if state.future is not None]
+        return not wait(futures, timeout).not_done
+
+    def stats(self):
+        return {uid: state.stats() for uid, state in list(self.states.items())}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,89 @@
+from concurrent.futures import Future
+from threading import Lock
+
+
+class OutputWriteError(Exception):
+    """
+    raised by the future of a write whose channels could not be written, failed maps (uid, channel) to the reason
+    """
+    def __init__(self, failed):
+        self.failed = failed
+        super().__init__(", ".join(f"{uid}/{channel}: {reason}" for (uid, channel), reason in failed.items()))
+
+
+class OutputTransaction:
+    """
+    the channels of one submit, its future resolves once every device involved has reported its write
+    """
+    def __init__(self, channels):
+        self.channels = channels
+        self.future = Future()
+        self.future.set_running_or_notify_cancel()
+        self.uids = {uid for uid, _ in channels}
+        self._lock = Lock()
+        self._waiting = set(self.uids)
+        self._written = {}
+        self._failed = {}
+
+    def channel_failed(self, key, reason):
+        """
+        fails a single channel before its device reports, e.g. a channel whose value was not applied
+        """
+        with self._lock:
+            self._failed[key] = reason
+
+    def device_done(self, uid, written=None, reason=None):
+        """
+        reports the write of a device: written are the values on the bus of all its channels, reason why it failed
+        """
+        with self._lock:
+            if uid not in self._waiting:
+                return
+            self._waiting.discard(uid)
+            for key in self.channels:
+                if key[0] != uid or key in self._failed:
+                    continue
+                if reason is None:
+                    self._written[key] = written[key[1]]
+                else:
+                    self._failed[key] = reason
+            done = not self._waiting
+        if done:
+            if self._failed:
+                self.future.set_exception(OutputWriteError(self._failed))
+            else:
+                self.future.set_result(self._written)
+
+
+class OutputWrites:
+    """
+    pending output writes between two output passes. All updates of one submit are applied in the same pass,
+    repeated writes to a channel are coalesced so only the last value goes to the bus
+    """
+    def __init__(self):
+        self._lock = Lock()
+        # (uid, channel) → value
+        self._pending = {}
+        self._transactions = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, updates):
+        """
+        queues {(uid, channel): value} and returns the transaction, its future resolves after the pass writing it
+        """
+        transaction = OutputTransaction(list(updates))
+        with self._lock:
+            self._pending.update(updates)
+            self._transactions.append(transaction)
+        return transaction
+
+    def take(self):
+        """
+        returns and forgets the pending values and their transactions, called by the main loop
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            transactions, self._transactions = self._transactions, []
+        return pending, transactions
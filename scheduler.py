@@ -0,0 +1,126 @@
+import heapq
+from threading import Lock
+from time import monotonic, sleep
+
+
+class DeadlineHeap:
+    """
+    deadlines keyed by device uid, the earliest one is available in O(1).
+    Rescheduling a key leaves the old heap entry behind, it is dropped lazily once it reaches the top
+    """
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+        # devices are scheduled from the callback threads while the main loop pops
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def schedule(self, key, deadline):
+        with self._lock:
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, key))
+
+    def remove(self, key):
+        with self._lock:
+            self._deadlines.pop(key, None)
+
+    def _drop_stale(self):
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def next_deadline(self):
+        """
+        earliest pending deadline or None
+        """
+        with self._lock:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def pop_expired(self, now):
+        """
+        removes and returns the keys whose deadline is not after now
+        """
+        expired = []
+        with self._lock:
+            self._drop_stale()
+            while self._heap and self._heap[0][0] <= now:
+                _, key = heapq.heappop(self._heap)
+                del self._deadlines[key]
+                expired.append(key)
+                self._drop_stale()
+        return expired
+
+
+class LoopScheduler:
+    """
+    fixed rate cycle timing, each cycle is due at start + n * period so the body duration does not add up to drift.
+    Cycles that are missed completely are skipped and counted as overruns
+    """
+    def __init__(self, period=0.1):
+        self.period = period
+        self.next_cycle = monotonic()
+        self.cycle_start = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.cycles = 0
+        self.overruns = 0
+        self.skipped_cycles = 0
+        self.jitter_sum = 0.0
+        self.jitter_max = 0.0
+        self.duration_sum = 0.0
+        self.duration_max = 0.0
+        self.last_duration = 0.0
+
+    def start(self):
+        self.next_cycle = monotonic()
+
+    def cycle_due(self):
+        return monotonic() >= self.next_cycle
+
+    def begin_cycle(self):
+        self.cycle_start = monotonic()
+        jitter = self.cycle_start - self.next_cycle
+        self.cycles += 1
+        self.jitter_sum += jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+
+    def end_cycle(self):
+        end = monotonic()
+        self.last_duration = end - self.cycle_start
+        self.duration_sum += self.last_duration
+        self.duration_max = max(self.duration_max, self.last_duration)
+        self.next_cycle += self.period
+        if end > self.next_cycle:
+            self.overruns += 1
+            missed = int((end - self.next_cycle) // self.period)
+            if missed:
+                self.skipped_cycles += missed
+                self.next_cycle += missed * self.period
+
+    def wait(self):
+        """
+        sleeps until the next cycle is due
+        """
+        delay = self.next_cycle - monotonic()
+        if delay > 0:
+            sleep(delay)
+
+    def stats(self):
+        cycles = self.cycles or 1
+        return {
+            "period": self.period,
+            "cycles": self.cycles,
+            "overruns": self.overruns,
+            "skipped_cycles": self.skipped_cycles,
+            "jitter_mean": self.jitter_sum / cycles,
+            "jitter_max": self.jitter_max,
+            "duration_mean": self.duration_sum / cycles,
+            "duration_max": self.duration_max,
+            "duration_last": self.last_duration,
+        }
@@ -0,0 +1,297 @@
+"""
+Live values of a TFH in a multiprocessing.shared_memory block for other processes, e.g. a front end.
+The main loop publishes once per cycle, readers attach by name and never touch the acquisition side.
+
+Block layout, native byte order:
+    0   8s  magic
+    8   u8  sequence, odd while the publisher writes (seqlock)
+    16  u8  layout generation, changes when the channel table is rewritten
+    24  u4  channel capacity
+    28  u4  channel count
+    32  u4  layout capacity in bytes
+    36  u4  layout size in bytes
+    40  f8  unix time of the last publish
+    48      json channel table [{"key", "uid", "channel", "kind": "input" | "output"}, ...]
+    ..      values f8[capacity], timestamps f8[capacity], operational u1[capacity]
+"""
+import json
+import os
+from collections import namedtuple
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock
+from time import sleep, time
+
+import numpy as np
+
+magic = b"TFHSHM\x00\x01"
+header_size = 48
+default_name = "tfh_snapshot"
+# seconds without a publish after which an existing block of the same name counts as left over
+stale_after = 5.0
+
+Snapshot = namedtuple("Snapshot", ["values", "timestamps", "operational", "published", "generation"])
+
+
+def block_size(capacity, layout_capacity):
+    return header_size + layout_capacity + capacity * 17
+
+
+class SnapshotBlock:
+    """
+    numpy views on the fields of a snapshot block
+    """
+    def __init__(self, shm):
+        self.shm = shm
+        buf = shm.buf
+        self.magic = bytes(buf[:8])
+        self.sequence = np.ndarray((1,), np.uint64, buf, 8)
+        self.generation = np.ndarray((1,), np.uint64, buf, 16)
+        capacity, _, layout_capacity, _ = np.ndarray((4,), np.uint32, buf, 24).tolist()
+        self.sizes = np.ndarray((4,), np.uint32, buf, 24)
+        self.published = np.ndarray((1,), np.float64, buf, 40)
+        self.capacity = capacity
+        self.layout_capacity = layout_capacity
+        offset = header_size + layout_capacity
+        self.values = np.ndarray((capacity,), np.float64, buf, offset)
+        self.timestamps = np.ndarray((capacity,), np.float64, buf, offset + 8 * capacity)
+        self.operational = np.ndarray((capacity,), np.uint8, buf, offset + 16 * capacity)
+
+    @property
+    def channel_count(self):
+        return int(self.sizes[1])
+
+    def layout(self):
+        size = int(self.sizes[3])
+        return json.loads(bytes(self.shm.buf[header_size:header_size + size]).decode()) if size else []
+
+    def write_layout(self, channels):
+        data = json.dumps(channels).encode()
+        if len(data) > self.layout_capacity:
+            raise ValueError("channel table exceeds the layout capacity of the snapshot block")
+        self.shm.buf[header_size:header_size + len(data)] = data
+        self.sizes[1] = len(channels)
+        self.sizes[3] = len(data)
+        self.generation[0] += 1
+
+    def release(self):
+        # the views have to be gone before the block can be closed
+        del self.sequence, self.generation, self.sizes, self.published, self.values, self.timestamps
+        del self.operational
+
+
+class SnapshotPublisher:
+    """
+    owns the shared memory block and copies the device values into it, called from the main loop after each cycle.
+    The block is sized with headroom so devices added by a config reload still fit
+    """
+    def __init__(self, tfh, name=default_name, capacity=None):
+        self.tfh = tfh
+        self.name = name
+        # publish runs in the main loop, close in the thread shutting down
+        self._lock = Lock()
+        self.closed = False
+        channels, self.plan = self.channel_table()
+        capacity = capacity or max(2 * len(channels), 64)
+        layout_capacity = max(4096, 2 * len(json.dumps(channels).encode()))
+        try:
+            self.shm = SharedMemory(name, create=True, size=block_size(capacity, layout_capacity))
+        except FileExistsError:
+            self.remove_stale(name)
+            self.shm = SharedMemory(name, create=True, size=block_size(capacity, layout_capacity))
+        self.shm.buf[:8] = magic
+        np.ndarray((4,), np.uint32, self.shm.buf, 24)[:] = (capacity, 0, layout_capacity, 0)
+        self.block = SnapshotBlock(self.shm)
+        self.block.write_layout(channels[:capacity])
+        self.layout_key = self.layout_signature()
+
+    @staticmethod
+    def remove_stale(name):
+        """
+        unlinks a block left over by a publisher that did not shut down. A block published within stale_after or
+        that is no tfh snapshot belongs to someone else and raises FileExistsError instead
+        """
+        existing = SharedMemory(name)
+        foreign = bytes(existing.buf[:8]) != magic
+        age = 0.0 if foreign else time() - float(np.ndarray((1,), np.float64, existing.buf, 40)[0])
+        if foreign or age < stale_after:
+            existing.close()
+            if os.name == "posix":
+                # only attached, the resource tracker would unlink it when this process ends
+                resource_tracker.unregister(existing._name, "shared_memory")
+            owner = "is no tfh snapshot" if foreign else f"was published {age:.1f} s ago by a running TFH"
+            raise FileExistsError(f"shared memory {name} {owner}, choose another snapshot name")
+        print(f"removing the snapshot block {name} left over {age:.0f} s ago")
+        existing.close()
+        existing.unlink()
+
+    def layout_signature(self):
+        tfh = self.tfh
+        return len(tfh.inputs), len(tfh.outputs), id(tfh.config)
+
+    def channel_table(self):
+        """
+        returns the channel table and the publish plan [(device dict, uid, start, channel count)]
+        """
+        tfh = self.tfh
+        keys = {}
+        for device_key, entry in (tfh.config or {}).items():
+            if not isinstance(entry, dict):
+                continue
+            if "input_device" in entry:
+                keys[("input", entry["input_device"], entry.get("input_channel", 0))] = device_key
+            if "output_device" in entry:
+                keys[("output", entry["output_device"], entry.get("output_channel", 0))] = device_key
+        channels, plan = [], []
+        for kind, devices in (("input", tfh.inputs), ("output", tfh.outputs)):
+            for uid, dev in list(devices.items()):
+                count = len(dev.values)
+                plan.append((devices, uid, len(channels), count))
+                channels.extend({"key": keys.get((kind, uid, channel), ""), "uid": uid, "channel": channel,
+                                 "kind": kind} for channel in range(count))
+        return channels, plan
+
+    def publish(self):
+        with self._lock:
+            if not self.closed:
+                self._publish()
+
+    def _publish(self):
+        block = self.block
+        if self.layout_signature() != self.layout_key:
+            self.layout_key = self.layout_signature()
+            channels, self.plan = self.channel_table()
+            if len(channels) > block.capacity:
+                print(f"snapshot {self.name} holds {block.capacity} of {len(channels)} channels")
+                channels = channels[:block.capacity]
+            block.sequence[0] += 1
+            block.write_layout(channels)
+            block.sequence[0] += 1
+
+        capacity = block.capacity
+        block.sequence[0] += 1
+        for devices, uid, start, count in self.plan:
+            dev = devices.get(uid)
+            end = start + count
+            if dev is None or end > capacity:
+                continue
+            block.values[start:end] = dev.values
+            times = getattr(dev, "timestamps", None)
+            if times is None:
+                times = getattr(dev, "write_times", None)
+            if times is not None:
+                block.timestamps[start:end] = times
+            block.operational[start:end] = getattr(dev, "operational", getattr(dev, "connected", True))
+        block.published[0] = time()
+        block.sequence[0] += 1
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.block.release()
+            self.shm.close()
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                # removed as stale by another publisher meanwhile
+                pass
+
+
+class SnapshotReader:
+    """
+    attaches to the snapshot block of a TFH in another process. read() returns a consistent copy,
+    values / timestamps / operational are zero-copy views that may change while being looked at
+    """
+    def __init__(self, name=default_name):
+        self.shm = SharedMemory(name)
+        if os.name == "posix":
+            # only the publisher owns the block, the resource tracker would unlink it when this process ends
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.block = SnapshotBlock(self.shm)
+        if self.block.magic != magic:
+            raise ValueError(f"shared memory {name} is no tfh snapshot")
+        self.generation = None
+        self.channels = []
+        # config key → {"input": index, "output": index}
+        self.offsets = {}
+        self.refresh_layout()
+
+    @property
+    def values(self):
+        return self.block.values[:len(self.channels)]
+
+    @property
+    def timestamps(self):
+        return self.block.timestamps[:len(self.channels)]
+
+    @property
+    def operational(self):
+        return self.block.operational[:len(self.channels)]
+
+    def refresh_layout(self, retries=1000):
+        """
+        reads the channel table, retried while the publisher writes
+        """
+        block = self.block
+        for _ in range(retries):
+            sequence = int(block.sequence[0])
+            if sequence & 1:
+                sleep(0)
+                continue
+            generation = int(block.generation[0])
+            try:
+                channels = block.layout()
+            except ValueError:
+                # rewritten while being read
+                continue
+            if int(block.sequence[0]) == sequence:
+                break
+        else:
+            raise TimeoutError("no consistent channel table, the publisher keeps writing or died while writing")
+        self.generation = generation
+        self.channels = channels
+        self.offsets = {}
+        for index, channel in enumerate(channels):
+            if channel["key"]:
+                self.offsets.setdefault(channel["key"], {})[channel["kind"]] = index
+
+    def read(self, retries=1000):
+        """
+        consistent copy of all channels, retried while the publisher writes
+        """
+        block = self.block
+        for _ in range(retries):
+            sequence = int(block.sequence[0])
+            if sequence & 1:
+                sleep(0)
+                continue
+            if int(block.generation[0]) != self.generation:
+                self.refresh_layout()
+                continue
+            n = len(self.channels)
+            snapshot = Snapshot(block.values[:n].copy(), block.timestamps[:n].copy(),
+                                block.operational[:n].astype(bool), float(block.published[0]), sequence)
+            if int(block.sequence[0]) == sequence:
+                return snapshot
+        raise TimeoutError("no consistent snapshot, the publisher keeps writing")
+
+    def index(self, key, kind=None):
+        """
+        channel index of a config key, the input channel unless kind "output" is asked for
+        """
+        offsets = self.offsets[key]
+        return offsets[kind] if kind else offsets.get("input", offsets.get("output"))
+
+    def get(self, key, kind=None):
+        """
+        (value, timestamp, operational) of one config key from a consistent snapshot
+        """
+        snapshot = self.read()
+        index = self.index(key, kind)
+        return snapshot.values[index], snapshot.timestamps[index], bool(snapshot.operational[index])
+
+    def close(self):
+        self.block.release()
+        self.shm.close()
@@ -5,78 +5,136 @@ import logging
 from datetime import datetime as dt
 from datetime import timedelta
 from enum import IntEnum
-import json
-from time import sleep
-
-from tinkerforge.brick_silent_stepper import BrickSilentStepper
-from tinkerforge.bricklet_thermocouple_v2 import BrickletThermocoupleV2
-from tinkerforge.bricklet_industrial_digital_out_4_v2 import BrickletIndustrialDigitalOut4V2
-from tinkerforge.bricklet_industrial_analog_out_v2 import BrickletIndustrialAnalogOutV2
-from tinkerforge.bricklet_analog_in_v3 import BrickletAnalogInV3
-from tinkerforge.bricklet_analog_out_v3 import BrickletAnalogOutV3
-from tinkerforge.bricklet_industrial_dual_analog_in_v2 import BrickletIndustrialDualAnalogInV2
-from tinkerforge.bricklet_industrial_dual_0_20ma_v2 import BrickletIndustrialDual020mAV2
-from tinkerforge.bricklet_industrial_dual_relay import BrickletIndustrialDualRelay
-from tinkerforge.bricklet_industrial_digital_in_4_v2 import BrickletIndustrialDigitalIn4V2
-from tinkerforge.bricklet_industrial_quad_relay_v2 import BrickletIndustrialQuadRelayV2
+from time import sleep, time, monotonic, monotonic_ns, perf_counter
+from array import array
+from math import nan
+from functools import lru_cache
+import importlib
 
+# the bricklet bindings are only imported once a matching device is set up, see load_bricklet
 from tinkerforge.ip_connection import IPConnection
-from tinkerforge.ip_connection import Error as IPConnError
-from threading import Thread
-from .control_types import Controls
-import inspect
+from threading import Thread, Event, Lock, Timer
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from .scheduler import LoopScheduler
+from .history import ChannelHistory, default_history_length
+from .control_plan import ControlPlan
+from .conditioning import ConditioningPlan
+from .brickd_hosts import BrickdHost, connect_hosts, parse_endpoints, hosts_config_key
+from .metrics import Metrics
+from .data_logger import DataLogger
+from .output_writes import OutputWrites
+from .output_dispatch import OutputDispatcher
+from .watchdog import FailsafeWatchdog
+from .shared_snapshot import SnapshotPublisher, default_name as default_snapshot_name
+from .config_loader import CallbackConfig, check_config, config_mtime, load_config, output_modes
+from .device_descriptors import InputDescriptor, device_descriptors
+from collections import Counter
 import itertools
+import numpy as np
 
 '''
 @ TODO: 🔲 ✅
  🔲 check the super init bevhiour in regards to setting a value after before super
  ✅ master brick reconnect handling 
  ✅make a listing of linked devices in case of connection loss for failsafes?
- 🔲 making Inputdevice and Outputdevice based on a baseclass 
+ ✅ making Inputdevice and Outputdevice based on a baseclass 
 '''
 
 default_timeout = timedelta(milliseconds=1000)
 
+# an input times out after missing this many callback periods, but never before min_timeout
+timeout_periods = 3
+min_timeout = timedelta(milliseconds=250)
+
+# seconds verify_config_devices waits for the required devices to answer the enumeration
+enumeration_timeout = 2.0
+# seconds without further enumerate answers after which a host counts as completely listed
+enumeration_settle = 0.2
+# devices configured in parallel by setup_devices
+setup_workers = 8
+# seconds a reconnect batch waits for the remaining lost devices of its master brick
+reconnect_batch_window = 0.5
+# seconds between two checks of the config file for changes, see TFH watch_config
+config_check_interval = 1.0
+# seconds the poll thread sleeps while no device is polled
+poll_idle_interval = 1.0
+# polls running at the same time, a bricklet that does not answer only blocks one of them until the bus timeout
+poll_workers = 4
+# seconds cleanup waits for the output writes in flight
+output_shutdown_timeout = 3.0
+
+
+def configure_sample_rate(input_dev):
+    """
+    sets the on-device sample rate of a bricklet with sample_rates, the device wide rate is the lowest one configured
+    for its channels. A rate the bricklet does not offer is replaced by the next lower one
+    """
+    rates = [cfg.sample_rate for cfg in input_dev.callback_configs if cfg.sample_rate]
+    if not rates:
+        return
+    supported = [rate for rate in input_dev.sample_rates if rate <= min(rates)] or [min(input_dev.sample_rates)]
+    if max(supported) != min(rates):
+        print(f"{input_dev.uid}: sample rate {min(rates)} sps not supported, using {max(supported)} sps")
+    input_dev.dev.set_sample_rate(input_dev.sample_rates[max(supported)])
 
-def get_config(config_name):
+
+def zeros(cnt):
     """
-    Lädt die Konfiguration entweder aus einer JSON-Datei oder aus dem config-Modul
-    und filtert dabei alle Einträge heraus, die den String "Modbus" (oder "Mobus") enthalten.
-    
-    :param config_name: Name der JSON-Datei (ohne Endung) oder False, um das config-Modul zu verwenden.
-    :return: Gefiltertes Konfigurationsdictionary oder None bei Fehler.
+    channel values are kept as C doubles, a timed out channel reads NaN
     """
-    def contains_modbus(item):
-        """
-        Rekursive Hilfsfunktion, die prüft, ob im übergebenen Objekt (String, Liste, Dict)
-        der Substring "modbus" (oder "mobus") enthalten ist.
-        """
-        if isinstance(item, str):
-            # Prüft in Kleinbuchstaben, ob "modbus" oder "mobus" vorkommt
-            return "modbus" in item.lower() or "mobus" in item.lower()
-        elif isinstance(item, dict):
-            return any(contains_modbus(value) for value in item.values())
-        elif isinstance(item, list):
-            return any(contains_modbus(elem) for elem in item)
-        else:
-            return False
+    return array("d", bytes(8 * cnt))
 
-    try:
-        # Konfiguration laden: entweder aus einer JSON-Datei oder aus dem config-Modul
-        if config_name:
-            with open(f'./json_files/{config_name}.json', 'r') as config_file:
-                config_data = json.load(config_file)
-        else:
-            import config as cfg
-            config_data = cfg.config  # Hier wird cfg.config verwendet
 
-        # Filtere alle Einträge, bei denen der Substring "Modbus" (oder "Mobus") irgendwo vorkommt
-        filtered_config = {k: v for k, v in config_data.items() if not contains_modbus(v)}
-        return filtered_config
+@lru_cache(maxsize=None)
+def load_bricklet(module_name, cls_name):
+    """
+    imports the tinkerforge binding class on first use, so only bindings of devices actually present get loaded
+    """
+    return getattr(importlib.import_module(f"tinkerforge.{module_name}"), cls_name)
 
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        print(f"Error loading config: {e}")
-        return None
+
+def drop_listener(listeners, listener, exp):
+    """
+    removes a listener that raised, a faulty consumer must not stop the callback thread or the main loop
+    """
+    msg = f"listener {getattr(listener, '__qualname__', listener)} failed and was removed: {exp!r}"
+    logging.error(msg)
+    print(msg)
+    if listener in listeners:
+        listeners.remove(listener)
+
+
+class DeviceRegistry:
+    """
+    maps the tinkerforge device identifier to the io class handling it and its display name.
+    Filled once when the device classes are defined, see TFH.Device.__init_subclass__
+    """
+    def __init__(self):
+        self.classes = {}
+        self.names = {13: "Master Brick"}
+
+    def register(self, cls):
+        self.classes[cls.device_type] = cls
+        self.names[cls.device_type] = cls.__name__
+
+    def get_cls(self, device_identifier, parent_cls=None):
+        cls = self.classes.get(device_identifier)
+        if cls is None or (parent_cls is not None and not issubclass(cls, parent_cls)):
+            return None
+        return cls
+
+    def get_name(self, device_identifier):
+        return self.names.get(device_identifier, "Unknown")
+
+
+device_registry = DeviceRegistry()
+
+
+def get_config(config_name):
+    """
+    Lädt die Konfiguration entweder aus einer JSON-Datei oder aus dem config-Modul, see config_loader.load_config
+    """
+    return load_config(config_name)
 
 
 class TFH:
@@ -99,217 +157,729 @@ class TFH:
             self.last_deviation = False
 
     class DummyDevice:
+        __slots__ = ("uid", "values")
+
         def __init__(self, uid, channel_cnt=4):
             self.uid = uid
-            self.values = [0] * channel_cnt
+            self.values = zeros(channel_cnt)
 
-    class InputDevice:
-        def __init__(self, uid, input_cnt, timeout=default_timeout):
+    class Device:
+        """
+        common base of input and output devices, every subclass defining a device_type is registered
+        in the device_registry. bricklet names the (module, class) of the tinkerforge binding
+        """
+        __slots__ = ()
+        device_type = None
+        bricklet = None
+        # channels of the bricklet, the channels of the config entries are checked against it, see check_channels
+        channel_count = 0
+
+        def __init_subclass__(cls, **kwargs):
+            super().__init_subclass__(**kwargs)
+            if "device_type" in cls.__dict__:
+                device_registry.register(cls)
+
+        def create_bricklet(self, uid, conn):
+            return load_bricklet(*self.bricklet)(uid, conn)
+
+        def configure(self):
+            """
+            callback and channel configuration of the bricklet, sent on setup and again after a reconnect
+            """
+
+        def restore(self):
+            """
+            brings the device back after its bricklet reconnected, the object and its state are kept
+            """
+            self.configure()
+
+    class InputDevice(Device):
+        __slots__ = ("uid", "dev", "input_cnt", "values", "timestamps", "activity_ns", "operational", "timeout_ns",
+                     "ioType", "history", "listeners", "callback_configs", "change_driven", "conditioned",
+                     "accumulator", "accumulator_lock")
+        # callback period in ms used for channels without a configured callback_period
+        default_period = 500
+
+        def __init__(self, uid, input_cnt, callback_configs=None):
+            """
+            callback_configs maps the channel to the CallbackConfig given by the config, see parse_callback_config
+            """
             self.uid = uid
+            self.dev = None
             self.input_cnt = input_cnt
-            self.values = [0] * input_cnt
-            self.activity_timestamp = dt.now()
+            self.values = zeros(input_cnt)
+            # unix time of the last sample per channel
+            self.timestamps = zeros(input_cnt)
+            # monotonic clock in ns of the last callback, the timeout is compared against it
+            self.activity_ns = monotonic_ns()
             self.operational = True
-            self.timeout = timeout
+            self.callback_configs = [self.resolve_callback_config((callback_configs or {}).get(channel))
+                                     for channel in range(input_cnt)]
+            # without periodic callbacks a silent device is not necessarily lost, see probe
+            self.change_driven = any(cfg.value_has_to_change or cfg.option != "x" or not cfg.period
+                                     for cfg in self.callback_configs)
+            self.timeout_ns = self.derive_timeout() // timedelta(microseconds=1) * 1000
             self.ioType = 0
+            self.history = []
+            # callables (uid, channel, value, timestamp) called from the callback thread on every sample
+            self.listeners = []
+            # channels handled by the ConditioningPlan, see set_conditioned
+            self.conditioned = None
+            self.accumulator = None
+            # guards the accumulator between the callback threads and the swap of the conditioning plan
+            self.accumulator_lock = Lock()
+
+        def resolve_callback_config(self, config):
+            """
+            fills the options left open by the config with the defaults of the device class
+            """
+            if config is None:
+                config = CallbackConfig(None, None, None, None, None, None)
+            period = self.default_period if config.period is None else int(config.period)
+            return config._replace(period=period, value_has_to_change=bool(config.value_has_to_change),
+                                   option=config.option or "x", minimum=config.minimum or 0,
+                                   maximum=config.maximum or 0)
+
+        def derive_timeout(self):
+            """
+            a configured timeout (ms) wins, otherwise timeout_periods of the slowest callback period
+            """
+            timeouts = [cfg.timeout for cfg in self.callback_configs if cfg.timeout]
+            if timeouts:
+                return timedelta(milliseconds=max(timeouts))
+            period = self.callback_period()
+            if not period:
+                return default_timeout
+            return max(timedelta(milliseconds=period * timeout_periods), min_timeout)
+
+        def callback_period(self):
+            """
+            period in ms at which the device is expected to report, the slowest channel with per channel callbacks
+            """
+            return max((cfg.period for cfg in self.callback_configs), default=0)
+
+        def probe(self):
+            """
+            checks a silent change driven device by a request instead of declaring it lost, True if it answered.
+            Blocks up to the bus timeout, called from the probe threads of the watchdog
+            """
+            try:
+                self.dev.get_identity()
+            except Exception:
+                return False
+            return True
+
+        def init_history(self, length=default_history_length, history=None):
+            """
+            allocates one ring buffer per channel, an existing history list is taken over instead (reconnects)
+            """
+            if history:
+                self.history = history
+            elif length:
+                self.history = [ChannelHistory(length) for _ in range(self.input_cnt)]
+
+        def store(self, channel, value, timestamp=None):
+            """
+            history and listeners always get the value as it came from the bricklet
+            """
+            if timestamp is None:
+                timestamp = time()
+            accumulated = False
+            if self.accumulator is not None:
+                with self.accumulator_lock:
+                    accumulator = self.accumulator
+                    if accumulator is not None and self.conditioned[channel]:
+                        # sum and count, the conditioning plan takes the mean of the samples of each cycle
+                        accumulator[channel] += value
+                        accumulator[self.input_cnt + channel] += 1
+                        accumulated = True
+            if not accumulated:
+                self.values[channel] = value
+            self.timestamps[channel] = timestamp
+            if self.history:
+                self.history[channel].append(value, timestamp)
+            for listener in self.listeners:
+                try:
+                    listener(self.uid, channel, value, timestamp)
+                except Exception as exp:
+                    drop_listener(self.listeners, listener, exp)
+
         def reset_activity(self):
-            self.activity_timestamp = dt.now()
+            self.activity_ns = monotonic_ns()
+
+        def new_accumulator(self):
+            return zeros(2 * self.input_cnt)
+
+        def set_conditioned(self, channels):
+            """
+            the samples of these channels are accumulated for the ConditioningPlan instead of being stored as values
+            """
+            with self.accumulator_lock:
+                if channels:
+                    self.conditioned = [channel in channels for channel in range(self.input_cnt)]
+                    self.accumulator = self.new_accumulator()
+                else:
+                    self.accumulator = None
+                    self.conditioned = None
+
+        def swap_accumulator(self, spare):
+            """
+            hands the accumulated samples to the conditioning plan, the callbacks continue in spare. Sum and count of
+            a sample always end up in the same accumulator
+            """
+            with self.accumulator_lock:
+                accumulator, self.accumulator = self.accumulator, spare
+            return accumulator
+
+        def deadline(self):
+            """
+            monotonic ns at which the device counts as timed out
+            """
+            return self.activity_ns + self.timeout_ns
+
+        def as_numpy(self):
+            """
+            float64 view on the current values without copying, updated in place by the callbacks
+            """
+            return np.frombuffer(self.values, dtype=np.float64)
 
         def collect_all(self, _args):
+            timestamp = time()
             for i, value in enumerate(_args):
                 # print(f"reading input on device {self.uid} - {i} {value}")
-                self.values[i] = value
+                self.store(i, value, timestamp)
             # @Todo: is there a less costly check?
             self.reset_activity()
 
     class IndustrialDualAnalogInV2(InputDevice):
         device_type = 2121
+        bricklet = ("bricklet_industrial_dual_analog_in_v2", "BrickletIndustrialDualAnalogInV2")
+        channel_count = 2
+        __slots__ = ()
+
+        def __init__(self, uid, conn, args, callback_configs=None):
+            super().__init__(uid, self.channel_count, callback_configs)
+            self.dev = self.create_bricklet(uid, conn)
+            self.configure()
+
+        # sample rate in sps → option of set_sample_rate, lower rates average more samples on the bricklet
+        sample_rates = {976: 0, 488: 1, 244: 2, 122: 3, 61: 4, 4: 5, 2: 6, 1: 7}
+
+        def single_callbacks(self):
+            # thresholds are only supported by the single channel callback
+            return any(cfg.option != "x" for cfg in self.callback_configs)
+
+        def callback_period(self):
+            if self.single_callbacks():
+                return super().callback_period()
+            # the all voltages callback runs at the shortest period of the channels
+            return min((cfg.period for cfg in self.callback_configs), default=0)
+
+        def configure(self):
+            configure_sample_rate(self)
+            if self.single_callbacks():
+                self.dev.register_callback(self.dev.CALLBACK_VOLTAGE, self.collect_single_voltage)
+                for channel, cfg in enumerate(self.callback_configs):
+                    self.dev.set_voltage_callback_configuration(channel, cfg.period, cfg.value_has_to_change,
+                                                                cfg.option, cfg.minimum, cfg.maximum)
+            else:
+                self.dev.register_callback(self.dev.CALLBACK_ALL_VOLTAGES, self.collect_all)
+                self.dev.set_all_voltages_callback_configuration(
+                    self.callback_period(), all(cfg.value_has_to_change for cfg in self.callback_configs))
 
-        def __init__(self, uid, conn, args):
-            super().__init__(uid, 2)
-            self.dev = BrickletIndustrialDualAnalogInV2(uid, conn)
-            self.dev.register_callback(self.dev.CALLBACK_ALL_VOLTAGES, self.collect_all)
-            self.dev.set_all_voltages_callback_configuration(500, False)
+        def collect_single_voltage(self, channel, value):
+            self.store(channel, value)
+            self.reset_activity()
 
     class IndustrialDual020mAV2(InputDevice):
         device_type = 2120
+        bricklet = ("bricklet_industrial_dual_0_20ma_v2", "BrickletIndustrialDual020mAV2")
+        channel_count = 2
+        __slots__ = ("current_channel",)
 
-        def __init__(self, uid, conn, args):
+        def __init__(self, uid, conn, args, callback_configs=None):
             self.current_channel = 0
-            super().__init__(uid, 2)
-            self.dev = BrickletIndustrialDual020mAV2(uid, conn)
-            for channel in range(self.input_cnt):
-                self.dev.register_callback(self.dev.CALLBACK_CURRENT, self.collect_single_current)
-                self.dev.set_current_callback_configuration(channel, 500,
-                                                        False, "x", 0, 0)
+            super().__init__(uid, self.channel_count, callback_configs)
+            self.dev = self.create_bricklet(uid, conn)
+            self.configure()
+
+        sample_rates = {240: 0, 60: 1, 15: 2, 4: 3}
+
+        def configure(self):
+            configure_sample_rate(self)
+            self.dev.register_callback(self.dev.CALLBACK_CURRENT, self.collect_single_current)
+            for channel, cfg in enumerate(self.callback_configs):
+                self.dev.set_current_callback_configuration(channel, cfg.period, cfg.value_has_to_change,
+                                                            cfg.option, cfg.minimum, cfg.maximum)
 
         def collect_single_current(self, channel, value):
-            self.values[channel] = value
+            self.store(channel, value)
             self.reset_activity()
             #print(f"reading input on device {self.uid} - {channel} {value}")
             
 
     class ThermoCouple(InputDevice):
         device_type = 2109
-        
-        def __init__(self, uid, conn, typ='N'):
-            super().__init__(uid, 1)
-            self.dev = BrickletThermocoupleV2(uid, conn)        
+        bricklet = ("bricklet_thermocouple_v2", "BrickletThermocoupleV2")
+        channel_count = 1
+        __slots__ = ("thermocouple_type",)
+        default_period = 100
+
+        def __init__(self, uid, conn, args, callback_configs=None):
+            super().__init__(uid, self.channel_count, callback_configs)
+            self.dev = self.create_bricklet(uid, conn)        
             type_dict = {'B': 0, 'E': 1, 'J': 2, 'K': 3, 'N': 4, 'R': 5, 'S': 6, 'T': 7}
-            thermocouple_type = type_dict[typ] 
+            typ = args[0] if args else 'N'
+            self.thermocouple_type = type_dict[typ] 
             #try:
             #    thermocouple_type = type_dict[typ.upper()]
             #except KeyError:
             #    print(f"invalid thermocouple config for {uid}, type not found {typ}")
             #    exit()
-            self.dev.set_configuration(16, thermocouple_type, 0)
+            self.configure()
+
+        def configure(self):
+            # samples averaged on the bricklet per value, 16 unless configured
+            averaging = self.callback_configs[0].averaging or 16
+            self.dev.set_configuration(averaging, self.thermocouple_type, 0)
             self.dev.register_callback(self.dev.CALLBACK_TEMPERATURE, self.collect_temperature)
-            self.dev.set_temperature_callback_configuration(100, False, "x", 0, 0)
+            cfg = self.callback_configs[0]
+            self.dev.set_temperature_callback_configuration(cfg.period, cfg.value_has_to_change, cfg.option,
+                                                            cfg.minimum, cfg.maximum)
 
         def collect_temperature(self, temperature):
-            self.values[0] = temperature/100
+            self.store(0, temperature/100)
             self.reset_activity()
 
     # @TODO: split PWM and Boolean handling
     class IndustrialDigitalIn4(InputDevice):
+        """
+        channels with a counter config use the hardware edge counter instead of the value callback. The counters are
+        polled in batches by the poll thread of TFH, the channel value is the pulse rate divided by
+        pulses_per_unit (e.g. liter per second of a flow meter)
+        """
         device_type = 2100
+        bricklet = ("bricklet_industrial_digital_in_4_v2", "BrickletIndustrialDigitalIn4V2")
+        channel_count = 4
+        __slots__ = ("counter_channels", "last_counts", "last_count_ns", "pulses", "frequencies", "poll_period_ns",
+                     "next_poll_ns")
+        default_period = 100
+        counter_mask = 0xFFFFFFFF
 
         def cb_value(self, channel, changed, value):
-            self.values[channel] = value
+            self.store(channel, value)
             self.reset_activity()
         
-        def __init__(self, uid, conn):
-            super().__init__(uid, 4)
-            self.dev = BrickletIndustrialDigitalIn4V2(uid, conn)
+        def resolve_callback_config(self, config):
+            config = super().resolve_callback_config(config)
+            if config.option != "x":
+                print(f"{self.uid}: digital inputs do not support thresholds, ignoring option {config.option}")
+                config = config._replace(option="x")
+            return config
+
+        def __init__(self, uid, conn, args, callback_configs=None):
+            super().__init__(uid, self.channel_count, callback_configs)
+            self.counter_channels = [channel for channel, cfg in enumerate(self.callback_configs) if cfg.counter]
+            # pulses counted since setup and pulse frequency in Hz of the last poll per channel
+            self.pulses = [0] * self.input_cnt
+            self.frequencies = zeros(self.input_cnt)
+            self.poll_period_ns = min((self.callback_configs[channel].period for channel in self.counter_channels),
+                                      default=0) * 1_000_000
+            self.next_poll_ns = 0
+            self.dev = self.create_bricklet(uid, conn)
+            self.configure()
+
+        def configure(self):
             self.dev.register_callback(self.dev.CALLBACK_VALUE, self.cb_value)
-            self.dev.set_value_callback_configuration(0, 100, False)
-            self.dev.set_value_callback_configuration(1, 100, False)
-            self.dev.set_value_callback_configuration(2, 100, False)
-            self.dev.set_value_callback_configuration(3, 100, False)
-            # TODO: consider configurations
-            # Configureing rising edge count (channel 3) with 10ms debounce
-            # self.dev.set_edge_count_configuration(3, 0, 10)
-
-    class OutputDevice:
-        def __init__(self, uid, output_cnt):
+            for channel, cfg in enumerate(self.callback_configs):
+                if cfg.counter:
+                    self.dev.set_edge_count_configuration(channel, cfg.counter.edge_type, cfg.counter.debounce)
+                    # the pulses are counted by the bricklet, the value callback of the channel stays off
+                    self.dev.set_value_callback_configuration(channel, 0, False)
+                else:
+                    self.dev.set_value_callback_configuration(channel, cfg.period, cfg.value_has_to_change)
+            # configuring an edge counter resets it to 0
+            self.last_counts = [0] * self.input_cnt
+            self.last_count_ns = [monotonic_ns()] * self.input_cnt
+
+        def poll(self):
+            """
+            reads the edge counters of all counter channels, the rate follows from the count delta since the last
+            poll. The counters are never reset so no pulse between two reads is lost
+            """
+            timestamp = time()
+            for channel in self.counter_channels:
+                count = self.dev.get_edge_count(channel, False)
+                now_ns = monotonic_ns()
+                delta = (count - self.last_counts[channel]) & self.counter_mask
+                elapsed_ns = now_ns - self.last_count_ns[channel]
+                self.last_counts[channel] = count
+                self.last_count_ns[channel] = now_ns
+                self.pulses[channel] += delta
+                frequency = delta * 1e9 / elapsed_ns if elapsed_ns > 0 else 0.0
+                self.frequencies[channel] = frequency
+                self.store(channel, frequency / self.callback_configs[channel].counter.pulses_per_unit, timestamp)
+            self.reset_activity()
+
+    class OutputDevice(Device):
+        __slots__ = ("uid", "dev", "output_cnt", "values", "ioType", "written", "write_times", "connected",
+                     "acknowledged", "bus_calls_sent", "bus_calls_suppressed", "write_failures")
+
+        def __init__(self, uid, output_cnt, values=None):
             self.uid = uid
             self.dev = None
             self.output_cnt = output_cnt
-            self.values = [0] * output_cnt
+            self.values = zeros(output_cnt)
+            if values:
+                # commanded values of the replaced device object, in place before configure writes them
+                cnt = min(len(values), output_cnt)
+                self.values[:cnt] = array("d", values[:cnt])
             self.ioType = TFH.OutputDevice
+            # last values acknowledged by the bricklet, NaN marks a channel as unknown and forces a write
+            self.written = array("d", [nan]) * output_cnt
+            # unix time of the last successful write per channel
+            self.write_times = zeros(output_cnt)
+            self.connected = True
+            # whether the bricklet currently confirms every write, see set_outputs
+            self.acknowledged = False
+            self.bus_calls_sent = 0
+            self.bus_calls_suppressed = 0
+            self.write_failures = 0
+
+        # bus calls a full rewrite of all channels takes, used to count the suppressed calls
+        full_write_calls = 1
+
+        def invalidate(self):
+            """
+            forgets the written state, the next output pass rewrites every channel
+            """
+            self.written = array("d", [nan]) * self.output_cnt
+
+        def restore(self):
+            """
+            re-applies the configuration and writes the last commanded values straight away instead of waiting for
+            the next output pass
+            """
+            self.invalidate()
+            self.configure()
+            self.set_outputs()
+            self.connected = True
+
+        def dirty_channels(self):
+            return [i for i, (value, written) in enumerate(zip(self.values, self.written)) if value != written]
+
+        def set_outputs(self, acknowledged=False, dirty=None):
+            """
+            writes only the channels changed since the last successful write. With acknowledged every write waits
+            for the confirmation of the bricklet and raises if it does not come. dirty may pass the channels
+            determined by the caller just before
+            """
+            if acknowledged != self.acknowledged:
+                self.dev.set_response_expected_all(acknowledged)
+                self.acknowledged = acknowledged
+            if dirty is None:
+                dirty = self.dirty_channels()
+            sent = 0
+            if dirty:
+                # values may change while the write is on its way, only what was sent counts as written
+                sending = array("d", self.values)
+                sent = self.write_channels(dirty)
+                now = time()
+                for i in dirty:
+                    self.written[i] = sending[i]
+                    self.write_times[i] = now
+            self.bus_calls_sent += sent
+            self.bus_calls_suppressed += max(self.full_write_calls - sent, 0)
+
+        def write_channels(self, channels):
+            """
+            sends the given channels to the bricklet and returns the number of bus calls made
+            """
+            return 0
 
     class DualRelay(OutputDevice):
         device_type = 284
+        bricklet = ("bricklet_industrial_dual_relay", "BrickletIndustrialDualRelay")
+        channel_count = 2
+        __slots__ = ()
 
-        def __init__(self, uid, conn, args):
-            super().__init__(uid, 2)
-            self.values = [False] * 2
-            self.dev = BrickletIndustrialDualRelay(uid, conn)
+        def __init__(self, uid, conn, args, values=None):
+            super().__init__(uid, self.channel_count, values)
+            self.dev = self.create_bricklet(uid, conn)
 
-        def set_outputs(self):
+        def write_channels(self, channels):
             self.dev.set_value(*self.values)
+            return 1
 
     class QuadRelayV2(OutputDevice):
         device_type = 2102
+        bricklet = ("bricklet_industrial_quad_relay_v2", "BrickletIndustrialQuadRelayV2")
+        channel_count = 4
+        __slots__ = ()
 
-        def __init__(self, uid, conn, args):
-            super().__init__(uid, 2)
-            self.values = [False, False, False , False]
-            self.dev = BrickletIndustrialQuadRelayV2(uid, conn)
+        def __init__(self, uid, conn, args, values=None):
+            super().__init__(uid, self.channel_count, values)
+            self.dev = self.create_bricklet(uid, conn)
 
-        def set_outputs(self):
+        def write_channels(self, channels):
             self.dev.set_value(self.values)
-
-    class IndustrialAnalogOutV2(OutputDevice):
-        device_type = 2116
-
-        def __init__(self, uid, conn, args):
-            super().__init__(uid, 2)
-            self.dev = BrickletIndustrialAnalogOutV2(uid, conn)
-            
-            if uid == "27A7":
-                self.dev.set_current(0)
-            else:
-                self.dev.set_voltage(0)
-            self.dev.set_enabled(True)              
-            self.dev.set_out_led_status_config(0, 5000, 1)
-
-
+            return 1
 
     class IndustrialDigitalOut4(OutputDevice):
         device_type = 2124
-
-        def __init__(self, uid, conn, args):
-            super().__init__(uid, 4)
-            self.values = [False] * 4
-            self.dev = BrickletIndustrialDigitalOut4V2(uid, conn)
+        bricklet = ("bricklet_industrial_digital_out_4_v2", "BrickletIndustrialDigitalOut4V2")
+        channel_count = 4
+        full_write_calls = 4
+        __slots__ = ("frequency",)
+
+        def __init__(self, uid, conn, args, values=None):
+            super().__init__(uid, self.channel_count, values)
+            self.dev = self.create_bricklet(uid, conn)
             self.frequency = 10
-            self.dev.set_pwm_configuration(0, self.frequency, 0)
-            self.dev.set_pwm_configuration(1, self.frequency, 0)
-            self.dev.set_pwm_configuration(2, self.frequency, 0)
-            self.dev.set_pwm_configuration(3, self.frequency, 0) 
+            self.configure()
 
-        def set_outputs(self):
-            self.dev.set_value(self.values)
-           #print(self.values)
-            self.dev.set_pwm_configuration(0, self.frequency, self.values[0]* self.frequency*1000)
-            self.dev.set_pwm_configuration(1, self.frequency, self.values[1]* self.frequency*1000)
-            self.dev.set_pwm_configuration(2, self.frequency, self.values[2]* self.frequency*1000)
-            self.dev.set_pwm_configuration(3, self.frequency, self.values[3]* self.frequency*1000)
+        def configure(self):
+            # the pwm configuration of all channels is the full write
+            self.set_outputs()
+
+        def write_channels(self, channels):
+            # every channel is driven by its pwm, duty 0 / 10000 switch it off / on. set_value would stop the pwm
+            # of the unchanged channels as well
+            for channel in channels:
+                self.dev.set_pwm_configuration(channel, self.frequency, self.values[channel]* self.frequency*1000)
+            return len(channels)
 
     # @TODD: WIP
     class SilentStepper(OutputDevice):
         device_type = 19
+        bricklet = ("brick_silent_stepper", "BrickSilentStepper")
+        channel_count = 1
+        __slots__ = ()
+        full_write_calls = 0
+
+        def __init__(self, uid, conn, args, values=None):
+            super().__init__(uid, self.channel_count, values)
+            self.dev = self.create_bricklet(uid, conn)
+            self.configure()
 
-        def __init__(self, uid, conn, args):
-            super().__init__(uid, 1)
-            self.dev = BrickSilentStepper(uid, conn)
+        def configure(self):
             self.dev.enable()
 
         def stop(self):
             self.dev.stop()
 
-    def __init__(self, ip, port, config_name=False, debug_mode=OperationModes.normalMode):
-        self.conn = IPConnection()
-        self.conn.connect(ip, port)
-        self.conn.register_callback(IPConnection.CALLBACK_ENUMERATE, self.cb_enumerate)
-        
+    class DescribedInput(InputDevice):
+        """
+        input device generated from an InputDescriptor, see device_class. Channels configured with poll (or all
+        channels of a bricklet without callback) are read by the poll thread of TFH every callback_period,
+        with one all_getter call per device if the bricklet has one
+        """
+        __slots__ = ("poll_channels", "poll_period_ns", "next_poll_ns")
+        descriptor = None
+        unit = ""
+
+        def __init__(self, uid, conn, args, callback_configs=None):
+            descriptor = self.descriptor
+            super().__init__(uid, self.channel_count, callback_configs)
+            self.poll_channels = [channel for channel, cfg in enumerate(self.callback_configs)
+                                  if cfg.poll or descriptor.callback is None]
+            self.poll_period_ns = min((self.callback_configs[channel].period for channel in self.poll_channels),
+                                      default=0) * 1_000_000
+            self.next_poll_ns = 0
+            self.dev = self.create_bricklet(uid, conn)
+            self.configure()
+
+        def configure(self):
+            descriptor = self.descriptor
+            if descriptor.callback is None:
+                return
+            callback, configuration = descriptor.callback
+            self.dev.register_callback(getattr(self.dev, f"CALLBACK_{callback}"), self.collect)
+            configure_callback = getattr(self.dev, configuration)
+            for channel, cfg in enumerate(self.callback_configs):
+                # polled channels keep their callback off
+                period = 0 if channel in self.poll_channels else cfg.period
+                channel_args = (channel,) if descriptor.channel_arg else ()
+                configure_callback(*channel_args, period, cfg.value_has_to_change, cfg.option, cfg.minimum,
+                                   cfg.maximum)
+
+        def collect(self, *args):
+            channel = args[0] if self.descriptor.channel_arg else 0
+            self.store(channel, args[-1] * self.descriptor.scale)
+            self.reset_activity()
+
+        def poll(self):
+            """
+            reads all polled channels in one go, they share a timestamp
+            """
+            descriptor = self.descriptor
+            timestamp = time()
+            scale = descriptor.scale
+            if descriptor.all_getter is not None and len(self.poll_channels) > 1:
+                values = getattr(self.dev, descriptor.all_getter)()
+                for channel in self.poll_channels:
+                    self.store(channel, values[channel] * scale, timestamp)
+            else:
+                getter = getattr(self.dev, descriptor.getter)
+                for channel in self.poll_channels:
+                    value = getter(channel) if descriptor.channel_arg else getter()
+                    self.store(channel, value * scale, timestamp)
+            self.reset_activity()
+
+    class DescribedOutput(OutputDevice):
+        """
+        output device generated from an OutputDescriptor, the setter follows from the output_mode configured for the
+        uid (passed in args, see device_args). Without one the legacy mode of the uid or the first mode of the
+        descriptor is used, with a warning if the descriptor has several
+        """
+        __slots__ = ("mode", "setter", "unit")
+        descriptor = None
+
+        def __init__(self, uid, conn, args, values=None):
+            descriptor = self.descriptor
+            super().__init__(uid, self.channel_count, values)
+            mode = next((arg for arg in args if arg in output_modes), None)
+            if mode is not None and mode not in descriptor.modes:
+                print(f"{uid}: {type(self).__name__} has no output_mode {mode}")
+                mode = None
+            if mode is None and len(descriptor.modes) > 1:
+                # which setter drives the actuator must not be guessed silently
+                mode = descriptor.legacy_modes.get(uid, next(iter(descriptor.modes)))
+                msg = (f"{uid} - {type(self).__name__} has no output_mode in the config, driving it as {mode}. "
+                       f"Set output_mode to one of {', '.join(descriptor.modes)}")
+                logging.warning(msg)
+                print(f"WARNING: {msg}")
+            self.mode = mode or next(iter(descriptor.modes))
+            self.setter, self.unit = descriptor.modes[self.mode]
+            self.dev = self.create_bricklet(uid, conn)
+            self.configure()
+
+        def configure(self):
+            # the commanded value (0 on first setup) is written before e.g. the output gets enabled
+            self.set_outputs()
+            for method, method_args in self.descriptor.setup:
+                getattr(self.dev, method)(*method_args)
+
+        def write_channels(self, channels):
+            setter = getattr(self.dev, self.setter)
+            for channel in channels:
+                if self.descriptor.channel_arg:
+                    setter(channel, self.values[channel])
+                else:
+                    setter(self.values[channel])
+            return len(channels)
+
+    @staticmethod
+    def device_class(descriptor):
+        """
+        generates the device class of an InputDescriptor / OutputDescriptor and registers it for its device type,
+        the class is also available as TFH.<descriptor name>
+        """
+        base = TFH.DescribedInput if isinstance(descriptor, InputDescriptor) else TFH.DescribedOutput
+        namespace = {"__slots__": (), "device_type": descriptor.device_type, "bricklet": descriptor.bricklet,
+                     "channel_count": descriptor.channels, "descriptor": descriptor,
+                     "__qualname__": f"TFH.{descriptor.name}"}
+        if base is TFH.DescribedInput:
+            namespace.update(default_period=descriptor.default_period, unit=descriptor.unit)
+        else:
+            namespace.update(full_write_calls=descriptor.channels)
+        cls = type(descriptor.name, (base,), namespace)
+        setattr(TFH, descriptor.name, cls)
+        return cls
+
+    def __init__(self, ip, port, config_name=False, debug_mode=OperationModes.normalMode, cycle_time=0.1,
+                 history_length=default_history_length, metrics=False, watch_config=False):
+        """
+        ip may be a single brickd host or a list of "host[:port]" endpoints, a "brickd_hosts" list in the
+        config takes precedence. Devices are addressed by their UID regardless of the host they are connected to.
+        With watch_config changes of the json config are applied while running, see reload_config
+        """
         self.devices_present = {}
         self.input_devices_required = set()
         self.output_devices_required = set()
         self.operation_mode = debug_mode
+        self.config_name = config_name
+        self.config_mtime = config_mtime(config_name)
         self.config = get_config(config_name)
+
+        endpoints = parse_endpoints(ip, port, self.config)
+        (self.config or {}).pop(hosts_config_key, None)
+        self.hosts = {}
+        for host, host_port in endpoints:
+            brickd = BrickdHost(host, host_port)
+            brickd.register_callbacks(self.cb_enumerate, self.cb_connected, self.cb_disconnected)
+            self.hosts[brickd.name] = brickd
+        if not connect_hosts(list(self.hosts.values())) and self.operation_mode != self.OperationModes.dummyMode:
+            raise ConnectionError(f"No brickd reachable at {', '.join(self.hosts)}")
+        # connection of the first host, kept for single host setups
+        self.conn = next(iter(self.hosts.values())).conn
+
         self.inputs = {}
         self.outputs = {}
         self.controls = {}
         self.args ={}
+        self.output_modes = {}
+        self.callback_configs = {}
+        # set by cb_enumerate once every required device has reported, see enumerate_devices
+        self.enumeration_complete = Event()
+        # reconnect handling: uid → monotonic time of the loss / of the reconnect, batches per master brick uid
+        self.lost_since = {}
+        self.reconnect_detected = {}
+        self.reconnect_batches = {}
+        self.reconnect_lock = Lock()
+        # uid → {"downtime": s or None, "restore": s} of the last recovery
+        self.recovery_times = {}
+        self.layout = None
+        self.watch_config = watch_config
+        self.next_config_check = monotonic() + config_check_interval
+        self.config_reload = Event()
+        self.history_length = history_length
+        self.scheduler = LoopScheduler(cycle_time)
+        # input deadlines, timeouts and the safe states of the outputs depending on a lost input
+        self.watchdog = FailsafeWatchdog(self)
+        self.control_plan = None
+        self.conditioning_plan = None
+        # shared with every input device, see InputDevice.listeners
+        self.value_listeners = []
+        # callables (flush_no) called by the main loop after each output pass, flush_no counts the passes started
+        self.flush_listeners = []
+        self.output_flushes_started = 0
+        self.output_writes = OutputWrites()
+        self.output_dispatcher = OutputDispatcher()
+        # uid → transactions of write_outputs waiting for an acknowledged write of the device
+        self.ack_waiters = {}
+        self.event_counters = {"timeouts": Counter(), "reconnects": Counter(), "disconnects": Counter()}
+        self.metrics = None
+        self.data_logger = None
+        self.snapshot = None
+        if metrics:
+            self.enable_metrics()
         self.verify_config_devices()
+        self.watchdog.start()
 
         self.run = True
         self.main_loop = Thread(target=self.__loop)
         self.main_loop.start()
+        self.poll_executor = ThreadPoolExecutor(max_workers=poll_workers, thread_name_prefix="tfh-poll")
+        self.poller = Thread(target=self.__poll_inputs, name="tfh-poller", daemon=True)
+        self.poller.start()
 
-    def get_brick_name(self, type_no):
-        if type_no == 13:
-            return "Master Brick"
-        for name, obj in inspect.getmembers(self):
-            if hasattr(obj, "__bases__") and any(_ in obj.__bases__ for _ in [self.InputDevice, self.OutputDevice]):
-                if type_no == obj.device_type:
-                    return name
-        return "Unknown"
+    @staticmethod
+    def get_brick_name(type_no):
+        return device_registry.get_name(type_no)
 
-    def get_io_cls(self, parent_cls, device_identifier):
+    @staticmethod
+    def get_io_cls(parent_cls, device_identifier):
         """
         returns the child cls of a given device identifier, if none matches it returns None
         """
-        for name, obj in inspect.getmembers(self):
-            if hasattr(obj, "__bases__") and parent_cls in obj.__bases__:
-                if obj.device_type == device_identifier:
-                    return obj
-        return None
+        return device_registry.get_cls(device_identifier, parent_cls)
 
     def cleanup(self):
         self.run = False
+        self.watchdog.stop()
+        self.stop_logging()
+        self.disable_snapshot()
         sleep(0.2)
         if  self.operation_mode != self.OperationModes.dummyMode:
             for uid, output_dev in self.outputs.items():
@@ -319,187 +889,581 @@ class TFH:
                     output_dev.stop()
                 except AttributeError:
                     pass
+            # quarantined devices get their chance to be switched off as well
+            self.output_dispatcher.wait(output_shutdown_timeout)
+            self.output_dispatcher.release()
             self.__manage_outputs()
+            self.output_dispatcher.wait(output_shutdown_timeout)
+        self.output_dispatcher.shutdown()
 
     def __loop(self):
         print("starting main loop")
+        self.scheduler.start()
+        while self.run:
+            if self.scheduler.cycle_due():
+                self.scheduler.begin_cycle()
+                self.__run_cycle()
+                self.scheduler.end_cycle()
+            if self.watch_config or self.config_reload.is_set():
+                self.__check_config()
+            self.scheduler.wait()
+
+    def __poll_inputs(self):
+        """
+        polls the input channels without callbacks (edge counters, channels configured with poll), each device at
+        the shortest callback_period of its polled channels. One thread schedules all of them, a device reads its
+        polled channels in one go on the poll executor with at most one poll in flight, so a bricklet that does not
+        answer delays neither the others nor the main loop
+        """
+        in_flight = {}
         while self.run:
+            now_ns = monotonic_ns()
+            wake_ns = now_ns + poll_idle_interval * 1_000_000_000
+            for input_dev in list(self.inputs.values()):
+                if not getattr(input_dev, "poll_period_ns", 0) or input_dev.uid in self.lost_since:
+                    continue
+                if now_ns >= input_dev.next_poll_ns:
+                    future = in_flight.get(input_dev.uid)
+                    if future is None or future.done():
+                        in_flight[input_dev.uid] = self.poll_executor.submit(self.__poll_device, input_dev)
+                    input_dev.next_poll_ns = max(input_dev.next_poll_ns + input_dev.poll_period_ns, now_ns)
+                wake_ns = min(wake_ns, input_dev.next_poll_ns)
+            sleep(max(wake_ns - monotonic_ns(), 0) / 1e9)
+        self.poll_executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def __poll_device(input_dev):
+        try:
+            input_dev.poll()
+        except Exception as exp:
+            # a lost device is reported by its timeout, failures are only printed until then
+            if input_dev.operational:
+                print(f"polling {input_dev.uid} failed: {exp}")
+
+    def get_counters(self):
+        """
+        uid → {channel: {"pulses", "frequency", "rate"}} of all channels in edge counter mode
+        """
+        counters = {}
+        for uid, input_dev in list(self.inputs.items()):
+            for channel in getattr(input_dev, "counter_channels", ()):
+                counters.setdefault(uid, {})[channel] = {"pulses": input_dev.pulses[channel],
+                                                         "frequency": input_dev.frequencies[channel],
+                                                         "rate": input_dev.values[channel]}
+        return counters
+
+    def __check_config(self):
+        if not self.config_reload.is_set():
+            now = monotonic()
+            if now < self.next_config_check:
+                return
+            self.next_config_check = now + config_check_interval
+            mtime = config_mtime(self.config_name)
+            if mtime is None or mtime == self.config_mtime:
+                return
+        self.config_reload.clear()
+        self.__apply_config_reload()
+
+    def reload_config(self):
+        """
+        requests the config to be loaded again, the main loop applies it before its next cycle
+        """
+        self.config_reload.set()
+
+    def __apply_config_reload(self):
+        """
+        applies only what differs from the running config: devices with changed entries, args or callback options
+        are set up again, removed ones are dropped, untouched devices keep running as they are.
+        An invalid config is rejected as a whole and the running one is kept
+        """
+        self.config_mtime = config_mtime(self.config_name)
+        config = get_config(self.config_name)
+        if config is None:
+            return False
+        config.pop(hosts_config_key, None)
+        layout = self.check_config(config)
+        if layout is None or not self.check_channels(config, layout):
+            print("config reload rejected, keeping the running config")
+            return False
+
+        old_layout = self.layout
+        changed = [uid for uid in layout.uids()
+                   if old_layout.device_signature(uid) != layout.device_signature(uid)]
+        removed = old_layout.uids() - layout.uids()
+        self.apply_layout(layout)
+        self.config = config
+
+        for uid in removed:
+            output_dev = self.outputs.pop(uid, None)
+            if output_dev is not None and not isinstance(output_dev, self.DummyDevice):
+                # a device no longer configured is left switched off
+                for index in range(output_dev.output_cnt):
+                    output_dev.values[index] = 0
+                try:
+                    # through the dispatcher, so it queues behind a write in flight instead of racing it
+                    self.output_dispatcher.write_now(output_dev).result(output_shutdown_timeout)
+                except FutureTimeout:
+                    print(f"switching off removed output {uid} timed out after {output_shutdown_timeout}s")
+                except Exception as exp:
+                    print(f"switching off removed output {uid} failed: {exp}")
+            self.inputs.pop(uid, None)
+            self.watchdog.remove(uid)
+            print(f"device {uid} removed from the config")
+        for uid in changed:
+            if uid in self.inputs and uid not in layout.input_uids:
+                self.inputs.pop(uid)
+                self.watchdog.remove(uid)
+            if uid in self.outputs and uid not in layout.output_uids:
+                self.outputs.pop(uid)
+            self.setup_device(uid)
+
+        self.controls = {device_key: self.controls.get(device_key) or self.Control()
+                         for device_key in layout.control_keys}
+        self.control_plan = None
+        self.conditioning_plan = None
+        print(f"config reloaded, {len(changed)} device(s) set up again, {len(removed)} removed")
+        return True
+
+    def __run_cycle(self):
+        metrics = self.metrics
+        if metrics is None:
             self.__manage_inputs()
+            self.__condition_inputs()
             self.__run_controls()
-            self.__manage_outputs()
-            sleep(0.1)
+            self.__flush_outputs()
+            return
+        start = perf_counter()
+        self.__manage_inputs()
+        self.__condition_inputs()
+        inputs_done = perf_counter()
+        self.__run_controls()
+        controls_done = perf_counter()
+        self.__flush_outputs()
+        metrics.observe_cycle(inputs_done - start, controls_done - inputs_done, perf_counter() - controls_done)
+
+    def __flush_outputs(self):
+        self.output_flushes_started += 1
+        pending, transactions = self.output_writes.take()
+        for (uid, channel), value in pending.items():
+            output_dev = self.outputs.get(uid)
+            if output_dev is not None:
+                output_dev.values[channel] = value
+        held = self.watchdog.hold_safe_states()
+        for transaction in transactions:
+            if held:
+                # the application value of these channels has just been overridden by their safe state
+                for key in transaction.channels:
+                    if key in held:
+                        transaction.channel_failed(key, "held by failsafe")
+            for uid in transaction.uids:
+                self.ack_waiters.setdefault(uid, []).append(transaction)
+        self.__manage_outputs()
+        for listener in self.flush_listeners:
+            try:
+                listener(self.output_flushes_started)
+            except Exception as exp:
+                drop_listener(self.flush_listeners, listener, exp)
+        if self.snapshot is not None:
+            self.snapshot.publish()
 
-    def __run_failsafe_control(self):
-        pass
+    def enable_metrics(self):
+        """
+        starts the hot path instrumentation, see Metrics for the snapshot and the prometheus export
+        """
+        if self.metrics is None:
+            metrics = Metrics(self)
+            metrics.attach()
+            self.metrics = metrics
+        return self.metrics
+
+    def disable_metrics(self):
+        if self.metrics is not None:
+            self.metrics.detach()
+            self.metrics = None
+
+    def start_logging(self, directory="./logs", **kwargs):
+        """
+        records all input samples in the background into binary files in directory, see DataLogger / LogReader
+        """
+        if self.data_logger is None:
+            self.data_logger = DataLogger(self, directory, **kwargs).start()
+        return self.data_logger
 
-    def __run_controls(self):
-        for control_name, control_rule in self.config.items():
-            # presence of these is already checked in verify_config_devices, not the value type
-            input_channel = control_rule.get("input_channel")
-            input_device_uid = control_rule.get("input_device")
-            output_channel = control_rule.get("output_channel")
-            output_device_uid = control_rule.get("output_device")
-
-            if self.operation_mode == 1 or input_device_uid is None or control_rule.get("type") == "easy_PI" or control_rule.get("type") == "direct_Heat" or "extern" in control_rule["type"].lower():
-                continue
-            if not self.inputs[input_device_uid].operational:
-                self.__run_failsafe_control()
-                continue
+    def enable_snapshot(self, name=default_snapshot_name):
+        """
+        publishes all channel values into the shared memory block name after every cycle,
+        other processes read it with shared_snapshot.SnapshotReader
+        """
+        if self.snapshot is None:
+            self.snapshot = SnapshotPublisher(self, name)
+            self.snapshot.publish()
+        return self.snapshot
 
-            input_val = self.inputs[input_device_uid].values[input_channel]
-
-            # a 0 value is technically False but ... not a sensible value either
-            permissible_deviation = control_rule.get("permissible_deviation", False)
-            if permissible_deviation:
-                delta = abs(input_val - self.outputs[output_device_uid].values[output_channel])
-                if delta > permissible_deviation * soll_input:
-                    last_deviation = self.controls[control_name].get("last_deviation")
-
-                    if last_deviation and last_deviation - dt.now() > timedelta(seconds=30):
-                        msg = f"device {control_name} is deviating more than the permissible amount"
-                        # @todo: make this happen only once?
-                        logging.warning(msg)
-                        print(msg)
-                    else:
-                        self.controls[control_name].last_deviation = dt.now()
-                else:
-                    self.controls[control_name].last_deviation = False
+    def disable_snapshot(self):
+        snapshot, self.snapshot = self.snapshot, None
+        if snapshot is not None:
+            snapshot.close()
 
-    def __manage_inputs(self):
+    def stop_logging(self):
+        if self.data_logger is not None:
+            self.data_logger.stop()
+            self.data_logger = None
+
+    def get_metrics_snapshot(self):
+        return self.metrics.snapshot() if self.metrics is not None else None
+
+    def get_history(self, uid, channel=0):
         """
-        purely managing timeouts and failsafe, the reading of values is done by the callbacks
+        ring buffer of the past samples of an input channel, None if the history is disabled
         """
-        now = dt.now()
+        history = getattr(self.inputs[uid], "history", None)
+        return history[channel] if history else None
 
-        for uid, input_dev in self.inputs.items():
-            if isinstance(input_dev, self.DummyDevice):
-                continue
-            input_dev.operational = True
-            delta = now - input_dev.activity_timestamp
-            if delta > input_dev.timeout:
-                input_dev.operational = False
-                for i in range(input_dev.input_cnt):
-                    input_dev.values[i] = "NAN"
-                print(f"timeout detected from uid {uid} {input_dev.activity_timestamp}")
+    def get_loop_stats(self):
+        """
+        cycle timing of the main loop: jitter, duration and overruns in seconds / counts
+        """
+        return self.scheduler.stats()
+
+    def __condition_inputs(self):
+        """
+        calibrates and filters the conditioned input channels, compiled again if a device object has been replaced
+        """
+        plan = self.conditioning_plan
+        if plan is None:
+            plan = self.conditioning_plan = ConditioningPlan.compile(self.layout.conditioning, self.inputs)
+        plan.step()
+
+    def __run_controls(self):
+        """
+        runs the precompiled control plan, compiled again if a device object has been replaced in between
+        """
+        if self.operation_mode == self.OperationModes.dummyMode:
+            return
+        plan = self.control_plan
+        if plan is None:
+            plan = self.control_plan = ControlPlan.compile(self.config, self.inputs, self.outputs)
+
+        overdue, started, ended = plan.check_deviations(monotonic())
+        for index in started:
+            self.controls[plan.names[index]].last_deviation = dt.now()
+        for index in ended:
+            self.controls[plan.names[index]].last_deviation = False
+        for index in overdue:
+            msg = f"device {plan.names[index]} is deviating more than the permissible amount"
+            logging.warning(msg)
+            print(msg)
+
+    def __manage_inputs(self):
+        """
+        purely managing the recovery of lost inputs, the reading of values is done by the callbacks and timeouts are
+        detected by the watchdog. An input counts as back once a callback arrived after it was tripped
+        """
+        watchdog = self.watchdog
+        for uid in list(watchdog.tripped):
+            input_dev = self.inputs.get(uid)
+            lost_ns = watchdog.lost_since(uid)
+            if input_dev is None or lost_ns is None or input_dev.activity_ns > lost_ns:
+                watchdog.clear(uid)
+                if input_dev is not None:
+                    input_dev.operational = True
+                    watchdog.schedule(uid, input_dev.deadline())
+                    print(f"input uid {uid} active again")
+
+    def input_lost(self, uid, reason, now_ns):
+        """
+        called by the watchdog when an input timed out or disconnected, after the safe states have been sent
+        """
+        input_dev = self.inputs.get(uid)
+        if input_dev is None:
+            return
+        input_dev.operational = False
+        for i in range(input_dev.input_cnt):
+            input_dev.values[i] = nan
+        if self.conditioning_plan is not None:
+            # the filters start over once the device is back
+            self.conditioning_plan.reset(input_dev)
+        if reason == "timeout":
+            self.event_counters["timeouts"][uid] += 1
+            print(f"timeout detected from uid {uid}, "
+                  f"last callback {(now_ns - input_dev.activity_ns) / 1e9:.3f} s ago")
+        else:
+            print(f"input uid {uid} lost: {reason}")
 
     def __manage_outputs(self):
+        """
+        hands the changed output values to the output dispatcher, the writes run concurrently and the main loop never
+        waits for them. The connection state is tracked by the enumerate and disconnect callbacks.
+        Devices with transactions waiting are written with confirmation, see write_outputs
+        """
+        dispatcher = self.output_dispatcher
+        ack_waiters = self.ack_waiters
         for uid, output_dev in self.outputs.items():
-
             if isinstance(output_dev, self.DummyDevice):
+                if uid in ack_waiters:
+                    written = output_dev.values
+                    for transaction in ack_waiters.pop(uid):
+                        transaction.device_done(uid, written)
                 continue
-
-            try:
-                _ = output_dev.dev.get_enabled()
-            except AttributeError as _:
-                # some devices like BrickletIndustrialDualRelay do not support this method
-                pass
-            except IPConnError as exp:
-                print(f"connection to output {uid} - "
-                      f"{type(output_dev).__name__} has been lost "
-                      f"{exp}")
-            try:
-                output_dev.set_outputs()
+            waiters = ack_waiters.get(uid)
+            if not output_dev.connected:
+                if waiters:
+                    self.__fail_waiters(uid, "disconnected")
                 continue
-            except AttributeError:
-                pass
 
-            try:
-                if uid == "27A7":
-                    output_dev.dev.set_current(output_dev.values[0])
+            result = dispatcher.dispatch(output_dev, bool(waiters))
+            if not waiters:
+                continue
+            if result is None:
+                written = output_dev.written
+                for transaction in ack_waiters.pop(uid):
+                    transaction.device_done(uid, written)
+            elif result == "quarantined":
+                self.__fail_waiters(uid, "quarantined")
+            elif result == "busy":
+                # the transactions wait for the next write unless the device stopped answering
+                if dispatcher.overdue(uid):
+                    self.__fail_waiters(uid, "not responding")
+            else:
+                result.add_done_callback(self.__write_done(uid, output_dev, ack_waiters.pop(uid)))
+
+        for uid in [uid for uid in ack_waiters if uid not in self.outputs]:
+            self.__fail_waiters(uid, "not configured")
+
+    def __fail_waiters(self, uid, reason):
+        for transaction in self.ack_waiters.pop(uid, ()):
+            transaction.device_done(uid, reason=reason)
+
+    @staticmethod
+    def __write_done(uid, output_dev, transactions):
+        def done(future):
+            exp = future.exception()
+            for transaction in transactions:
+                if exp is None:
+                    transaction.device_done(uid, output_dev.written)
                 else:
-                    output_dev.dev.set_voltage(output_dev.values[0])
-                # @TODO there needs to be a check on the channels and device specific fncs/class or whatever
-            except Exception as exp:
-                print(exp)
+                    transaction.device_done(uid, reason=str(exp))
+        return done
+
+    def get_failsafe_stats(self):
+        """
+        trips of the watchdog and the reaction time in seconds from the loss of an input to the confirmed safe state
+        of its outputs, overall and per input
+        """
+        return self.watchdog.stats()
+
+    def get_output_dispatch_stats(self):
+        """
+        per uid: number of writes, latency (last, mean, max in seconds), deadline misses, failures and quarantine
+        """
+        return self.output_dispatcher.stats()
+
+    def write_outputs(self, updates):
+        """
+        sets many output channels at once: updates maps (uid, channel) or a config key to the value.
+        All updates are applied in the same output pass, several writes to a channel before that pass are coalesced.
+        Returns a concurrent.futures.Future resolving to {(uid, channel): value} once the bricklets confirmed the
+        writes, or failing with OutputWriteError. A channel already holding the value counts as written, a channel
+        held at its safe state by a tripped input fails with "held by failsafe"
+        """
+        resolved = {}
+        for key, value in updates.items():
+            if isinstance(key, str):
+                entry = self.config.get(key) or {}
+                if "output_device" not in entry:
+                    raise KeyError(f"{key} is no output of the config")
+                key = (entry["output_device"], entry.get("output_channel", 0))
+            uid, channel = key
+            output_dev = self.outputs.get(uid)
+            if output_dev is None:
+                raise KeyError(f"output {uid} is not set up")
+            if not 0 <= channel < len(output_dev.values):
+                raise IndexError(f"output {uid} has no channel {channel}")
+            resolved[(uid, channel)] = value
+        return self.output_writes.submit(resolved).future
+
+    def get_output_bus_stats(self):
+        """
+        number of bus calls sent to and suppressed for the output devices, in total and per uid
+        """
+        stats = {"sent": 0, "suppressed": 0, "devices": {}}
+        for uid, output_dev in self.outputs.items():
+            if isinstance(output_dev, self.DummyDevice):
+                continue
+            stats["sent"] += output_dev.bus_calls_sent
+            stats["suppressed"] += output_dev.bus_calls_suppressed
+            stats["devices"][uid] = {"sent": output_dev.bus_calls_sent,
+                                     "suppressed": output_dev.bus_calls_suppressed}
+        return stats
 
     def verify_config_devices(self):
         """
         collects the UIDs of the connected device and checks against the listing of UIDs given from the config
-        If not every required device is given an Error is given
+        If not every required device is given an Error is given. An invalid config ends the program after all of
+        its errors are listed
         """
-
-        print("listing devices present: \n")
         # @todo define required and optional device from parsing
+        layout = self.check_config(self.config)
+        if layout is None:
+            exit()
+        self.apply_layout(layout)
+        for device_key in layout.control_keys:
+            self.controls[device_key] = self.Control()
+        print(f"VALID config with {len(layout.control_keys)} entries!")
 
-        self.conn.enumerate()
-        sleep(0.2)
-
+        if not self.enumerate_devices() and self.operation_mode != self.OperationModes.dummyMode:
+            print("enumeration incomplete, required devices missing")
         if not len(self.devices_present) and self.operation_mode != self.OperationModes.dummyMode:
             raise ConnectionError("No Tinkerforge module found, check connection to master brick")
-
-        channels_required = {}
-        self.uid_to_device_keys = {}  # UID → Liste von device_keys, falls mehrere Keys dasselbe Gerät verwenden
-
-        for device_key, value in self.config.items():
-            self.args[device_key] = " "
-            print(f"checking devices for {device_key}")
-            type_requirements = Controls.types.get(value["type"], Controls.Entries.hasOutputs + Controls.Entries.hasInputs)
-             # Überspringe externe Geräte, z.B. Modbus oder über andere Protokolle
-            if "type" in value and "extern" in value["type"].lower():
-                print(f"Skipping device {device_key} because its type is 'extern'")
-                continue
-            if "type" in value and "modbus_pump" in value["type"].lower():
-                print(f"Skipping device {device_key} because its type is 'Modbus_Pump'")
-                continue
-            if "input_device" in value and "modbus" in value["input_device"].lower() or "output_device" in value and "modbus" in value["output_device"].lower():
-                print(f"Skipping device {device_key} because its type is 'Modbus_Pump'")
-                continue
-
-            if type_requirements & Controls.Entries.hasOutputs:
-                if not all(key in value for key in ("output_device", "output_channel")):
-                    print(f"invalid config for device {device_key} due to missing output parameter")
-                    exit()
-                output_uid = value.get("output_device")
-                used_output_channels = channels_required.get(output_uid, [])
-                req_output_chann = value.get("output_channel")
-                if req_output_chann in used_output_channels:
-                    print(f"invalid config: {device_key} has overlapping channels with previous configured devices")
-                    exit()
-                used_output_channels.append(req_output_chann)
-                channels_required[output_uid] = used_output_channels
-                self.output_devices_required.add(output_uid)
-                # Zuordnung UID → device_key
-                self.uid_to_device_keys.setdefault(output_uid, []).append(device_key)
-
-            if type_requirements & Controls.Entries.hasInputs:
-                # Spezielle Behandlung für Thermoelemente
-                if value["type"] == "thermocouple":
-                    if "tc_type" not in value:
-                        print(f"tc_type fehlt für Gerät {device_key}, Programm wird beendet")
-                        exit()
-                    else:
-                        self.args[device_key] = value.get("tc_type")
-
-                # Allgemeine Prüfung auf fehlende Parameter
-                if not all(key in value for key in ("input_device", "input_channel")) and not value["type"] == "thermocouple" :
-                    print(f"invalid config for device {device_key} due to missing input parameter")
-                    exit()
-                input_uid = value.get("input_device")
-                used_input_channels = channels_required.get(input_uid, [])
-                req_input_chann = value.get("input_channel")
-                if req_input_chann in used_input_channels:
-                    print(f"invalid config: {device_key} has overlapping channels with previous configured devices")
-                    exit()
-                used_input_channels.append(req_input_chann)
-                channels_required[input_uid] = used_input_channels
-                self.input_devices_required.add(input_uid)
-                 # Zuordnung UID → device_key
-                self.uid_to_device_keys.setdefault(input_uid, []).append(device_key)
-
-            self.controls[device_key] = self.Control()
-            print("VALID config!")
+        if not self.check_channels(self.config, layout):
+            exit()
 
         self.setup_devices()
+        self.control_plan = ControlPlan.compile(self.config, self.inputs, self.outputs)
+        print(f"compiled control plan with {len(self.control_plan)} supervised controls")
+        self.conditioning_plan = ConditioningPlan.compile(self.layout.conditioning, self.inputs)
+        if len(self.conditioning_plan):
+            print(f"conditioning {len(self.conditioning_plan)} input channel(s)")
 
         for uid in itertools.chain(self.input_devices_required, self.output_devices_required):
             if uid not in self.devices_present and self.operation_mode == 0:
                 raise ModuleNotFoundError(f"Missing Tinkerforge Element: {uid}")
         print("\nvalid setup for configured initialisation detected \n")
 
+    @staticmethod
+    def check_config(config):
+        """
+        validates a config, prints all errors found and returns its DeviceLayout, None if it is invalid
+        """
+        layout, errors = check_config(config)
+        for device_key in layout.skipped:
+            print(f"Skipping device {device_key} because its type is 'extern' or 'Modbus'")
+        if errors:
+            print(f"invalid config, {len(errors)} error(s):")
+            for error in errors:
+                print(f"  {error}")
+            return None
+        return layout
+
+    def check_channels(self, config, layout):
+        """
+        checks the entries against the device classes of the present devices: input / output device, channel within
+        the channels of the bricklet and an output_mode the device has. Prints all errors and returns True if there
+        are none, devices not present or of unknown type are left to setup_device
+        """
+        errors = []
+        for uid in sorted(layout.uids()):
+            device_identifier = self.devices_present.get(uid, {}).get("device_identifier")
+            if device_registry.get_cls(device_identifier) is None:
+                continue
+            name = device_registry.get_name(device_identifier)
+            for role, parent_cls in (("input", TFH.InputDevice), ("output", TFH.OutputDevice)):
+                device_keys = [device_key for device_key in layout.uid_to_device_keys.get(uid, [])
+                               if config[device_key].get(f"{role}_device") == uid]
+                if not device_keys:
+                    continue
+                cls = self.get_io_cls(parent_cls, device_identifier)
+                if cls is None:
+                    errors.extend(f"{device_key}: {uid} ({name}) is no {role} device" for device_key in device_keys)
+                    continue
+                for device_key in device_keys:
+                    channel = config[device_key].get(f"{role}_channel", 0)
+                    if not 0 <= channel < cls.channel_count:
+                        errors.append(f"{device_key}: {role}_channel {channel} out of range, {uid} ({name}) has "
+                                      f"{cls.channel_count} channel(s)")
+                output_mode = layout.output_modes.get(uid)
+                if role == "output" and output_mode is not None and \
+                        output_mode not in getattr(getattr(cls, "descriptor", None), "modes", ()):
+                    errors.append(f"{uid}: {name} has no output_mode {output_mode}")
+        if errors:
+            print(f"invalid config for the present devices, {len(errors)} error(s):")
+            for error in errors:
+                print(f"  {error}")
+        return not errors
+
+    def apply_layout(self, layout):
+        self.layout = layout
+        self.input_devices_required = set(layout.input_uids)
+        self.output_devices_required = set(layout.output_uids)
+        self.uid_to_device_keys = layout.uid_to_device_keys
+        self.args = layout.args
+        self.output_modes = layout.output_modes
+        self.callback_configs = layout.callback_configs
+
+    def enumerate_devices(self, timeout=enumeration_timeout):
+        """
+        enumerates all connected hosts and waits until every required device has reported, returns True if the
+        enumeration is complete. A host stops holding up the wait once its answers settled for enumeration_settle,
+        one that does not answer at all after timeout. Without a connected host there is nothing to wait for
+        """
+        print("listing devices present: \n")
+        self.enumeration_complete.clear()
+        hosts = [brickd for brickd in self.hosts.values() if brickd.connected]
+        for brickd in hosts:
+            brickd.last_enumerate = None
+            brickd.conn.enumerate()
+        self.check_enumeration()
+        deadline = monotonic() + timeout
+        while hosts and not self.enumeration_complete.wait(enumeration_settle / 4):
+            now = monotonic()
+            if now >= deadline or all(brickd.last_enumerate is not None
+                                      and now - brickd.last_enumerate >= enumeration_settle for brickd in hosts):
+                break
+        return self.enumeration_complete.is_set()
+
+    def check_enumeration(self):
+        required = itertools.chain(self.input_devices_required, self.output_devices_required)
+        if self.devices_present and all(uid in self.devices_present for uid in required):
+            self.enumeration_complete.set()
+
+    def get_device_conn(self, uid):
+        """
+        IPConnection of the brickd the device is connected to
+        """
+        host = self.devices_present.get(uid, {}).get("host")
+        return self.hosts[host].conn if host in self.hosts else self.conn
+
+    def cb_connected(self, connect_reason, host=None):
+        brickd = self.hosts.get(host)
+        if brickd is None:
+            return
+        brickd.connected = True
+        if connect_reason == IPConnection.CONNECT_REASON_AUTO_RECONNECT:
+            print(f"connection to brickd {host} restored, enumerating devices")
+            brickd.conn.enumerate()
+
+    def cb_disconnected(self, disconnect_reason, host=None):
+        print(f"connection to brickd {host} lost, reason {disconnect_reason}")
+        if host in self.hosts:
+            self.hosts[host].connected = False
+        now = monotonic()
+        for uid, device_entry in list(self.devices_present.items()):
+            if host is None or device_entry.get("host") == host:
+                self.lost_since.setdefault(uid, now)
+        for uid, output_dev in self.outputs.items():
+            if isinstance(output_dev, self.DummyDevice):
+                continue
+            if host is None or self.devices_present.get(uid, {}).get("host") == host:
+                output_dev.connected = False
+        for uid, input_dev in list(self.inputs.items()):
+            if isinstance(input_dev, self.DummyDevice):
+                continue
+            if host is None or self.devices_present.get(uid, {}).get("host") == host:
+                self.watchdog.trip(uid, f"connection to brickd {host} lost")
+
     def cb_enumerate(self, uid, connected_uid, _, hardware_version, firmware_version,
-                     device_identifier, enumeration_type):
+                     device_identifier, enumeration_type, host=None):
 
+        if host in self.hosts:
+            self.hosts[host].last_enumerate = monotonic()
         if enumeration_type == IPConnection.ENUMERATION_TYPE_DISCONNECTED:
+            output_dev = self.outputs.get(uid)
+            if output_dev is not None and not isinstance(output_dev, self.DummyDevice):
+                output_dev.connected = False
+            if uid in self.inputs and not isinstance(self.inputs[uid], self.DummyDevice):
+                self.watchdog.trip(uid, "disconnected")
+            self.lost_since.setdefault(uid, monotonic())
+            self.event_counters["disconnects"][uid] += 1
             # in case of a master disconnect the device_type is listed as 0 for all lost devices
             try:
                 dev = self.devices_present[uid]
@@ -513,21 +1477,128 @@ class TFH:
             return
 
         if uid not in self.devices_present.keys():
-            self.devices_present[uid] = {"device_identifier": device_identifier, "parent_uid": connected_uid}
+            self.devices_present[uid] = {"device_identifier": device_identifier, "parent_uid": connected_uid,
+                                         "host": host}
             print("UID:               " + uid)
+            print("Host:              " + str(host))
             print("Connected UID:     " + connected_uid)
             # print("Position:          " + _)
             print("Hardware Version:  " + str(hardware_version))
             print("Firmware Version:  " + str(firmware_version))
             print("Device Identifier: " + str(device_identifier) + f" - {self.get_brick_name(device_identifier)}")
             print("")
+            if not self.enumeration_complete.is_set():
+                self.check_enumeration()
+        elif self.devices_present[uid].get("host") != host:
+            print(f"UID {uid} reported by {host} is already connected to {self.devices_present[uid].get('host')}, "
+                  f"ignoring it")
         else:
             print(f"reconnect detected from device: {uid} - "
                   f"{self.get_brick_name(device_identifier)}")
-            if uid in itertools.chain(self.input_devices_required, self.output_devices_required):
+            self.event_counters["reconnects"][uid] += 1
+            self.queue_reconnect(uid)
+
+    def required_children(self, parent_uid):
+        return [uid for uid in itertools.chain(self.input_devices_required, self.output_devices_required)
+                if self.devices_present.get(uid, {}).get("parent_uid") == parent_uid]
+
+    def queue_reconnect(self, uid):
+        """
+        collects the reconnecting devices per master brick, a batch is restored as soon as all lost devices of its
+        master have reported again or reconnect_batch_window passed
+        """
+        batch_key = uid if self.required_children(uid) else self.devices_present[uid].get("parent_uid")
+        required = uid in self.input_devices_required or uid in self.output_devices_required
+        with self.reconnect_lock:
+            batch = self.reconnect_batches.get(batch_key)
+            if batch is None:
+                timer = Timer(reconnect_batch_window, self.flush_reconnect_batch, (batch_key,))
+                timer.daemon = True
+                batch = self.reconnect_batches[batch_key] = {"uids": [], "timer": timer}
+                timer.start()
+            if not required:
+                self.lost_since.pop(uid, None)
+            elif uid not in batch["uids"]:
+                self.reconnect_detected[uid] = monotonic()
+                batch["uids"].append(uid)
+            expected = [child for child in self.required_children(batch_key) if child in self.lost_since]
+            complete = batch["uids"] and all(child in batch["uids"] for child in expected)
+        if complete:
+            # restoring waits for the bricklets, the callback thread has to keep delivering the other devices
+            Thread(target=self.flush_reconnect_batch, args=(batch_key,), daemon=True).start()
+
+    def flush_reconnect_batch(self, batch_key):
+        with self.reconnect_lock:
+            batch = self.reconnect_batches.pop(batch_key, None)
+        if batch is None:
+            return
+        batch["timer"].cancel()
+        uids = batch["uids"]
+        if not uids:
+            return
+        with ThreadPoolExecutor(max_workers=min(setup_workers, len(uids))) as executor:
+            list(executor.map(self.restore_device, uids))
+
+    def restore_device(self, uid):
+        """
+        fast reconnect path: the existing device object gets its configuration again, outputs their last commanded
+        values. Devices without an object yet are set up from scratch
+        """
+        dev = self.inputs.get(uid) or self.outputs.get(uid)
+        if dev is None or isinstance(dev, self.DummyDevice):
+            self.setup_device(uid)
+        else:
+            try:
+                if uid in self.outputs:
+                    # in turn with the writes of the dispatcher, one write in flight per device
+                    self.output_dispatcher.restore(dev).result()
+                else:
+                    dev.restore()
+            except Exception as exp:
+                print(f"restoring device {uid} failed: {exp}, setting it up again")
                 self.setup_device(uid)
+        input_dev = self.inputs.get(uid)
+        if input_dev is not None and not isinstance(input_dev, self.DummyDevice):
+            self.watchdog.schedule(uid, input_dev.deadline())
+        # a device answering again is no longer quarantined
+        self.output_dispatcher.release(uid)
+
+        now = monotonic()
+        lost = self.lost_since.pop(uid, None)
+        detected = self.reconnect_detected.pop(uid, now)
+        self.recovery_times[uid] = {"downtime": now - lost if lost is not None else None, "restore": now - detected}
+        if lost is not None:
+            print(f"device {uid} recovered after {now - lost:.3f} s, restored in {(now - detected) * 1000:.1f} ms")
+        else:
+            print(f"device {uid} restored in {(now - detected) * 1000:.1f} ms")
+
+    def get_recovery_stats(self):
+        """
+        downtime and restore duration in seconds of the last recovery per uid
+        """
+        return dict(self.recovery_times)
 
-    def setup_device(self, uid, args=()):
+    def device_args(self, uid):
+        """
+        args of all config entries using the device, blank args left out. The output_mode of an output uid comes last,
+        it never reaches an input device
+        """
+        args = []
+        for device_key in self.uid_to_device_keys.get(uid, []):
+            arg = self.args.get(device_key)
+            if str(arg).strip() and arg not in args:
+                args.append(arg)
+        output_mode = self.output_modes.get(uid)
+        if output_mode is not None and uid not in self.input_devices_required:
+            args.append(output_mode)
+        return tuple(args)
+
+    def setup_device(self, uid, args=None):
+        """
+        builds the io device of a present uid, args default to the merged args of its config entries
+        """
+        if args is None:
+            args = self.device_args(uid)
         device_entry = self.devices_present.get(uid)
         if device_entry is None:
             print(f"Setup of not present device requested {uid}")
@@ -544,21 +1615,31 @@ class TFH:
         try:
             old_values = self.outputs[uid].values
         except (KeyError, AttributeError):
-            old_values = False
+            old_values = None
+        old_history = getattr(self.inputs.get(uid), "history", None)
         cls = self.get_io_cls(TFH.InputDevice, device_identifier)
         if cls is not None:
             #print(args)
-            dev = self.inputs[uid] = cls(uid, self.conn, args)
+            dev = cls(uid, self.get_device_conn(uid), args, self.callback_configs.get(uid))
+            dev.init_history(self.history_length, old_history)
+            dev.listeners = self.value_listeners
+            lost_ns = self.watchdog.lost_since(uid)
+            if lost_ns is not None:
+                # set up again while tripped: only a real sample counts as back, not the setup itself
+                dev.activity_ns = lost_ns
+            self.inputs[uid] = dev
+            self.watchdog.schedule(uid, dev.deadline())
         else:
             cls = self.get_io_cls(TFH.OutputDevice, device_identifier)
             if cls is not None:
-                dev = self.outputs[uid] = cls(uid, self.conn, args)
+                dev = self.outputs[uid] = cls(uid, self.get_device_conn(uid), args, old_values)
             else:
                 print(f"{uid} failed to setup device due to unknown device type {device_identifier}")
                 exit()
 
-        if old_values:
-            dev.values = old_values
+        # the control and conditioning plans refer to the replaced device object
+        self.control_plan = None
+        self.conditioning_plan = None
             
         if any(str(arg).strip() for arg in args):
             print(f"successfully setup device {uid} - {type(dev).__name__} "
@@ -567,8 +1648,16 @@ class TFH:
             print(f"successfully setup device {uid} - {type(dev).__name__}")
 
     def setup_devices(self):
-        for key in itertools.chain(self.input_devices_required, self.output_devices_required):
-            device_keys = self.uid_to_device_keys.get(key, [])
-            for dk in device_keys:
-                args = self.args.get(dk, ())
-                self.setup_device(key, args)
+        """
+        sets up every required device exactly once, the devices are independent of each other and configured
+        concurrently since each bricklet costs a few round trips to the brickd
+        """
+        uids = list(dict.fromkeys(itertools.chain(self.input_devices_required, self.output_devices_required)))
+        if not uids:
+            return
+        with ThreadPoolExecutor(max_workers=min(setup_workers, len(uids))) as executor:
+            list(executor.map(self.setup_device, uids))
+
+
+for descriptor in device_descriptors:
+    TFH.device_class(descriptor)
@@ -0,0 +1,230 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread
+from time import monotonic_ns
+
+from .scheduler import DeadlineHeap
+
+# seconds from the loss of an input to the confirmed safe state of its outputs that count as in time
+default_budget = 0.05
+# change driven devices silent for half their timeout are probed concurrently, a probe waits for the bus timeout
+probe_workers = 4
+
+
+class FailsafeWatchdog:
+    """
+    supervises the input devices independently of the main loop cycle. Every input has a deadline, a callback moves
+    it by updating the activity of the device, which the watchdog only looks at once the deadline passed. Change
+    driven devices are probed in the background from half their timeout on, an answer moves the deadline as well.
+    On expiry or a disconnect the input is tripped: its values become NaN and the outputs depending on it (safe_state /
+    failsafe_inputs in the config) are written with confirmation straight away. The time from the expired deadline
+    or the disconnect to the confirmed write is measured against the budget
+    """
+    def __init__(self, tfh, budget=default_budget):
+        self.tfh = tfh
+        self.budget = budget
+        self.deadlines = DeadlineHeap()
+        self.wakeup = Event()
+        self.running = False
+        self.thread = None
+        self.probes = ThreadPoolExecutor(max_workers=probe_workers, thread_name_prefix="tfh-probe")
+        self.probing = set()
+        self._lock = Lock()
+        # uid → (reason, monotonic ns of the trip) while an input is tripped
+        self.tripped = {}
+        self.trips = 0
+        self.reactions = 0
+        self.reaction_last = 0.0
+        self.reaction_max = 0.0
+        self.reaction_total = 0.0
+        self.detection_max = 0.0
+        self.budget_exceeded = 0
+        self.write_failures = 0
+        # uid → {"reason", "detection", "reaction"} of the last trip, reaction in s or None until confirmed
+        self.last = {}
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.thread = Thread(target=self._run, name="tfh-watchdog", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(1)
+        self.probes.shutdown(wait=False, cancel_futures=True)
+
+    def schedule(self, uid, deadline):
+        input_dev = self.tfh.inputs.get(uid)
+        if getattr(input_dev, "change_driven", False):
+            # early enough for the probe to answer before the deadline
+            deadline -= input_dev.timeout_ns // 2
+        self.deadlines.schedule(uid, deadline)
+        # the new deadline may be earlier than the one the watchdog sleeps for
+        self.wakeup.set()
+
+    def remove(self, uid):
+        self.deadlines.remove(uid)
+        with self._lock:
+            self.tripped.pop(uid, None)
+
+    def _run(self):
+        deadlines = self.deadlines
+        while self.running:
+            self.wakeup.clear()
+            now = monotonic_ns()
+            for uid in deadlines.pop_expired(now):
+                self._expired(uid, now)
+            deadline = deadlines.next_deadline()
+            self.wakeup.wait(None if deadline is None else max(deadline - monotonic_ns(), 0) / 1e9)
+
+    def _expired(self, uid, now):
+        tfh = self.tfh
+        input_dev = tfh.inputs.get(uid)
+        if input_dev is None or isinstance(input_dev, tfh.DummyDevice) or uid in self.tripped:
+            return
+        deadline = input_dev.deadline()
+        if deadline <= now:
+            # never waits for a probe still running
+            self.trip(uid, "timeout", deadline)
+        elif not input_dev.change_driven or now < deadline - input_dev.timeout_ns // 2:
+            # callbacks arrived in between
+            self.schedule(uid, deadline)
+        else:
+            if uid not in self.probing:
+                self.probing.add(uid)
+                self.probes.submit(self._probe, input_dev)
+            self.deadlines.schedule(uid, deadline)
+
+    def _probe(self, input_dev):
+        uid = input_dev.uid
+        try:
+            if input_dev.probe():
+                with self._lock:
+                    # a tripped input only comes back with a real sample
+                    if uid not in self.tripped:
+                        input_dev.reset_activity()
+            else:
+                self.trip(uid, "timeout")
+        finally:
+            self.probing.discard(uid)
+            self.wakeup.set()
+
+    def trip(self, uid, reason, since_ns=None):
+        """
+        declares an input lost and switches its dependent outputs to their safe state, since_ns is the monotonic
+        time of the loss (the expired deadline), now if not given. An input is only tripped once until it is cleared,
+        nothing is tripped before start or after stop
+        """
+        now = monotonic_ns()
+        since = now if since_ns is None else since_ns
+        with self._lock:
+            if not self.running or uid in self.tripped:
+                return
+            self.tripped[uid] = (reason, now)
+            self.trips += 1
+        detection = (now - since) / 1e9
+        self.detection_max = max(self.detection_max, detection)
+        self.last[uid] = {"reason": reason, "detection": detection, "reaction": None}
+        futures = self.apply_safe_states(uid)
+        self.tfh.input_lost(uid, reason, now)
+        if not futures:
+            return
+        pending = [len(futures)]
+        failed = []
+
+        def confirmed(future):
+            exp = future.exception()
+            with self._lock:
+                if exp is not None:
+                    failed.append(exp)
+                pending[0] -= 1
+                if pending[0]:
+                    return
+            self._reaction(uid, since, failed)
+
+        for future in futures:
+            future.add_done_callback(confirmed)
+
+    def _reaction(self, uid, since, failed):
+        reaction = (monotonic_ns() - since) / 1e9
+        if failed:
+            self.write_failures += 1
+            print(f"failsafe of input {uid}: safe state not confirmed after {reaction * 1000:.1f} ms: {failed[0]}")
+            return
+        self.last[uid]["reaction"] = reaction
+        self.reactions += 1
+        self.reaction_last = reaction
+        self.reaction_total += reaction
+        self.reaction_max = max(self.reaction_max, reaction)
+        if reaction > self.budget:
+            self.budget_exceeded += 1
+            print(f"failsafe of input {uid}: safe state confirmed after {reaction * 1000:.1f} ms, "
+                  f"exceeding the budget of {self.budget * 1000:.0f} ms")
+
+    def safe_states(self, uid):
+        layout = self.tfh.layout
+        return layout.safe_states.get(uid, ()) if layout is not None else ()
+
+    def apply_safe_states(self, uid):
+        """
+        sets the safe values of the outputs depending on the input and starts their confirmed writes,
+        returns the futures of the writes
+        """
+        tfh = self.tfh
+        devices = {}
+        for _, out_uid, channel, value in self.safe_states(uid):
+            output_dev = tfh.outputs.get(out_uid)
+            if output_dev is None:
+                continue
+            output_dev.values[channel] = value
+            devices[out_uid] = output_dev
+        futures = []
+        for out_uid, output_dev in devices.items():
+            if isinstance(output_dev, tfh.DummyDevice):
+                continue
+            if not output_dev.connected:
+                print(f"failsafe of input {uid}: output {out_uid} is disconnected, safe state not written")
+                continue
+            futures.append(tfh.output_dispatcher.write_now(output_dev))
+        return futures
+
+    def hold_safe_states(self):
+        """
+        called by the main loop before each output pass, outputs of tripped inputs keep their safe values.
+        Returns the (uid, channel) held this way
+        """
+        if not self.tripped:
+            return ()
+        held = set()
+        outputs = self.tfh.outputs
+        for uid in list(self.tripped):
+            for _, out_uid, channel, value in self.safe_states(uid):
+                output_dev = outputs.get(out_uid)
+                if output_dev is not None:
+                    output_dev.values[channel] = value
+                    held.add((out_uid, channel))
+        return held
+
+    def clear(self, uid):
+        """
+        the input is back, its outputs are released to the values written by the application again
+        """
+        with self._lock:
+            self.tripped.pop(uid, None)
+
+    def lost_since(self, uid):
+        """
+        monotonic ns of the trip of an input, None if it is not tripped
+        """
+        tripped = self.tripped.get(uid)
+        return tripped[1] if tripped is not None else None
+
+    def stats(self):
+        return {"budget": self.budget, "trips": self.trips, "tripped": sorted(self.tripped),
+                "reactions": self.reactions, "reaction_last": self.reaction_last, "reaction_max": self.reaction_max,
+                "reaction_mean": self.reaction_total / self.reactions if self.reactions else 0.0,
+                "detection_max": self.detection_max, "budget_exceeded": self.budget_exceeded,
+                "write_failures": self.write_failures, "inputs": dict(self.last)}